@@ -0,0 +1,138 @@
+"""Mergeable summaries of PBeast values.
+
+A Summary keeps count, min, max, mean and the sum of squared deviations
+(Welford), plus a QuantileSketch for the percentiles. Two summaries of
+disjoint sets of values merge into the summary of their union, so per
+lumiblock summaries can be combined into per run ones without going back
+to the rows.
+"""
+import math
+import json
+import collections
+
+RELATIVE_ACCURACY = 0.01
+MIN_VALUE = 1e-12 # Magnitudes below go to the zero bucket
+
+
+class QuantileSketch(object):
+    """Log bucketed histogram (DDSketch). Quantiles are within
+    relative_accuracy of an actual value and merging two sketches is adding
+    their bucket counts, so the result does not depend on the merge order."""
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = collections.Counter()
+        self.negative = collections.Counter()
+        self.zeros = 0
+
+    def index(self, magnitude):
+        return int(math.ceil(math.log(magnitude) / self.log_gamma))
+
+    def bucket_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value):
+        if value > MIN_VALUE:
+            self.positive[self.index(value)] += 1
+        elif value < -MIN_VALUE:
+            self.negative[self.index(-value)] += 1
+        else:
+            self.zeros += 1
+
+    @property
+    def count(self):
+        return sum(self.positive.values()) + sum(self.negative.values()) + self.zeros
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches of different accuracy")
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zeros += other.zeros
+
+    def quantile(self, q):
+        count = self.count
+        if not count:
+            return None
+        rank = q * (count - 1)
+        seen = 0
+        # Ascending values: largest negative magnitudes first
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self.bucket_value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self.bucket_value(index)
+        return self.bucket_value(max(self.positive))
+
+    def dumps(self):
+        return json.dumps({"a": self.relative_accuracy, "z": self.zeros,
+                           "p": self.positive, "n": self.negative},
+                          separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, text):
+        state = json.loads(text)
+        sketch = cls(state["a"])
+        sketch.zeros = state["z"]
+        sketch.positive.update(dict((int(k), v) for k, v in state["p"].items()))
+        sketch.negative.update(dict((int(k), v) for k, v in state["n"].items()))
+        return sketch
+
+
+class Summary(object):
+    def __init__(self, count=0, minimum=None, maximum=None, mean=0.0, m2=0.0,
+                 sketch=None):
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self.m2 = m2
+        self.sketch = sketch or QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.sketch.add(value)
+
+    def merge(self, other):
+        """Chan et al. pairwise update of mean and m2"""
+        if not other.count:
+            return
+        if not self.count:
+            self.minimum, self.maximum = other.minimum, other.maximum
+        else:
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.sketch.merge(other.sketch)
+
+    @property
+    def variance(self):
+        """Population variance"""
+        if not self.count:
+            return None
+        return self.m2 / self.count
+
+    def quantile(self, q):
+        """Sketch estimate, kept within the exact min and max"""
+        value = self.sketch.quantile(q)
+        if value is None:
+            return None
+        return min(max(value, self.minimum), self.maximum)
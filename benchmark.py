@@ -0,0 +1,186 @@
+#!/usr/bin/env python2.7
+"""End to end ingest benchmark against the offline PBeast stand-in.
+
+Every PBeast dataset is retrieved in its own process, into its own fresh
+DB, from a pbeast_standin server, lumiblock by lumiblock as retrieve
+--multiple would do it. For each one the rows per second, the seconds
+spent in every stage (get_data, parse_input, transform, insert) and the
+peak RSS of the process are reported. With --stream the stages are lazy
+and the work shows up under insert.
+
+Results can be saved with --output and compared with --baseline; a dataset
+whose throughput drops, or whose stage time grows, by more than
+--tolerance is reported as a regression and the exit status is 1.
+
+    ./benchmark.py --lumiblocks 10 --bulk --output before.json
+    ./benchmark.py --lumiblocks 10 --bulk --baseline before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import resource
+import subprocess
+import collections
+
+import pbeast_standin
+
+RUN_NUMBER = 284000
+BASE_TIME = 1448136000
+STAGES = ("get_data", "parse_input", "transform", "insert")
+MIN_STAGE_SECONDS = 0.05 # Shorter stages are too noisy to compare
+RESULT_FILENAME = "result.json"
+
+
+def run_dataset(args):
+    """Worker: retrieve every lumiblock of one dataset, timing its stages"""
+    import masada
+    import get_pbeast_data
+    logging.getLogger().setLevel(logging.WARNING)
+
+    masada.db.init(os.path.join(args.workdir, "bench.db"))
+    masada.db.connect()
+    masada.db.create_tables(masada.BaseModel.__subclasses__(), safe=True)
+    masada.RunModel.create(run_number=RUN_NUMBER, stime=BASE_TIME,
+            etime=BASE_TIME + args.lumiblocks * args.length)
+    # Windows end a second before the next lumiblock, the RoSModel key has
+    # no lumiblock and PBeast answers include both ends
+    for lumiblock in range(args.lumiblocks):
+        masada.LumiBlockModel.create(run_number=RUN_NUMBER, lumiblock=lumiblock,
+                stime=BASE_TIME + lumiblock * args.length,
+                etime=BASE_TIME + (lumiblock + 1) * args.length - 1)
+    masada.db.close()
+
+    get_pbeast_data.configure(url=args.url, sso=False)
+    options = dict(bulk=args.bulk, columnar=args.columnar, stream=args.stream,
+            backend=args.backend, store_dir=os.path.join(args.workdir, "series"))
+
+    klass = getattr(masada, args.worker)
+    stages = collections.OrderedDict((stage, 0.0) for stage in STAGES)
+    start = time.time()
+    for lumiblock in range(args.lumiblocks):
+        data_set = klass(run_number=RUN_NUMBER, lumiblock=lumiblock,
+                stime=BASE_TIME + lumiblock * args.length,
+                etime=BASE_TIME + (lumiblock + 1) * args.length - 1, **options)
+        for stage in STAGES:
+            stage_start = time.time()
+            getattr(data_set, stage)()
+            stages[stage] += time.time() - stage_start
+    seconds = time.time() - start
+
+    masada.db.connect()
+    rows = sum(entry.rows for entry in masada.IngestLedgerModel.select())
+    masada.db.close()
+
+    # ru_maxrss is in kB on Linux
+    result = dict(dataset=args.worker, rows=rows, seconds=seconds,
+            rows_per_second=rows / seconds if seconds else 0.0, stages=stages,
+            peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    with open(os.path.join(args.workdir, RESULT_FILENAME), "w") as f:
+        json.dump(result, f)
+
+
+def run_all(args, datasets):
+    """Run a worker process per dataset, return their results"""
+    server = None
+    url = args.url
+    if url is None:
+        server = pbeast_standin.server_from_args(args)
+        server.start()
+        url = server.url
+
+    tmpdir = tempfile.mkdtemp(prefix="masada-bench-")
+    results = []
+    try:
+        for name in datasets:
+            workdir = os.path.join(tmpdir, name)
+            os.makedirs(workdir)
+            command = [sys.executable, os.path.abspath(__file__), "--worker", name,
+                    "--workdir", workdir, "--url", url, "--backend", args.backend,
+                    "--lumiblocks", str(args.lumiblocks), "--length", str(args.length)]
+            command.extend("--%s" % flag for flag in ("bulk", "columnar", "stream")
+                    if getattr(args, flag))
+            subprocess.check_call(command)
+            with open(os.path.join(workdir, RESULT_FILENAME)) as f:
+                results.append(json.load(f))
+            report([results[-1]], header=len(results) == 1)
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def report(results, header=True):
+    if header:
+        print("%-28s %9s %11s %s %9s" % ("dataset", "rows", "rows/s",
+            " ".join("%11s" % stage for stage in STAGES), "rss MB"))
+    for result in results:
+        print("%-28s %9d %11.0f %s %9.1f" % (result["dataset"], result["rows"],
+            result["rows_per_second"],
+            " ".join("%11.3f" % result["stages"][stage] for stage in STAGES),
+            result["peak_rss_mb"]))
+    sys.stdout.flush()
+
+
+def regressions(results, baseline, tolerance):
+    """Descriptions of what got slower than the baseline results"""
+    found = []
+    previous = dict((result["dataset"], result) for result in baseline)
+    for result in results:
+        before = previous.get(result["dataset"])
+        if before is None:
+            continue
+        if result["rows_per_second"] < before["rows_per_second"] * (1 - tolerance):
+            found.append("%s: %.0f rows/s, was %.0f" % (result["dataset"],
+                result["rows_per_second"], before["rows_per_second"]))
+        for stage in STAGES:
+            seconds, was = result["stages"][stage], before["stages"][stage]
+            if seconds > MIN_STAGE_SECONDS and seconds > was * (1 + tolerance):
+                found.append("%s: %s took %.3fs, was %.3fs" % (result["dataset"],
+                    stage, seconds, was))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest benchmark against the offline PBeast stand-in')
+    parser.add_argument('--dataset', nargs='+', help="Datasets to benchmark, all the PBeast ones by default")
+    parser.add_argument('--lumiblocks', type=int, default=5, help="Lumiblocks retrieved per dataset")
+    parser.add_argument('--length', type=int, default=600, help="Seconds per lumiblock")
+    parser.add_argument('--bulk', action='store_true', help="As retrieve --bulk")
+    parser.add_argument('--columnar', action='store_true', help="As retrieve --columnar")
+    parser.add_argument('--stream', action='store_true', help="As retrieve --stream")
+    parser.add_argument('--backend', default='sqlite', help="As retrieve --backend")
+    parser.add_argument('--url', help="readSeries URL of an already running server, instead of an in-process stand-in")
+    parser.add_argument('--output', help="Save the results as JSON")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Slowdown fraction reported as a regression")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    pbeast_standin.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_dataset(args)
+        sys.exit(0)
+
+    datasets = args.dataset
+    if not datasets:
+        import masada
+        datasets = masada.pbeast_datasets
+    results = run_all(args, datasets)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print("REGRESSION %s" % regression)
+        if found:
+            sys.exit(1)
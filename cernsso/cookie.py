@@ -1,17 +1,21 @@
 import os
 import time
+import fcntl
+import logging
 import sqlite3
 import tempfile
 import cookielib
 import json
+import threading
+import contextlib
 from tempfile import mkstemp
 from urlparse import urlparse
 
-from sh import cern_get_sso_cookie
-
 
 DB_FILENAME = "cookie.db"
 ROT_TIME = 24 * 60 * 60 # 24 hours
+REFRESH_AHEAD = 2 * 60 * 60 # Refresh in the background this long before ROT_TIME
+RETRY_DELAY = 5 * 60 # Between failed background refreshes
 
 
 class CookieManager(object):
@@ -37,22 +41,35 @@ class CookieManager(object):
         """)
         self.conn.commit()
 
-    def get_cookie(self, url):
-        domain = urlparse(url).hostname
-        self.cursor.execute("SELECT * FROM cookies WHERE domain=?", (domain, ) )
-        res = self.cursor.fetchone()
+    def get_cookie(self, url, use_certs = True):
+        res = self.stored_cookie(url)
 
         if not res:
-            return self.get_new_cookie(url)
+            return self.get_new_cookie(url, use_certs)
 
-        domain, last_update, cookie = res
+        last_update, cookie = res
 
         if int(time.time()) - last_update > ROT_TIME:
-            return self.get_new_cookie(url)
+            return self.get_new_cookie(url, use_certs)
 
-        return json.loads(cookie)
+        return cookie
+
+    def stored_cookie(self, url):
+        """(last_update, cookie) from the DB, None if there is none"""
+        domain = urlparse(url).hostname
+        self.cursor.execute("SELECT last_update, cookie FROM cookies WHERE domain=?",
+                            (domain, ))
+        res = self.cursor.fetchone()
+        if not res:
+            return None
+        return res[0], json.loads(res[1])
+
+    def close(self):
+        self.conn.close()
 
     def get_new_cookie(self, url, use_certs = True):
+        # sh resolves the command on import, only needed on a cache miss
+        from sh import cern_get_sso_cookie
         _, cookietmp = mkstemp(prefix='.tmp', dir=self.workdir, text=True)
         params_dict = {"r": True,
                        "u": url,
@@ -79,3 +96,112 @@ class CookieManager(object):
             (urlparse(url).hostname, int(time.time()), cookie)
         )
         self.conn.commit()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock across processes, held for the with block"""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CookieProvider(object):
+    """SSO cookie for one URL, shared by every thread of a process.
+
+    The cookie is kept in memory. Once it is older than ROT_TIME minus
+    REFRESH_AHEAD, the next get() starts a refresh in a background thread
+    and requests keep using the current cookie meanwhile. Refreshes are
+    serialized across processes with a lock file next to the cookie DB: a
+    process that waited for the lock first looks at the DB, where the
+    holder may just have stored a fresh cookie, and only runs the SSO
+    handshake if it did not.
+    """
+    def __init__(self, workdir, url, use_certs = True,
+                 refresh_ahead = REFRESH_AHEAD):
+        self.workdir = workdir
+        self.url = url
+        self.use_certs = use_certs
+        self.refresh_ahead = refresh_ahead
+        self.lockpath = os.path.join(workdir, DB_FILENAME + ".lock")
+        self.lock = threading.Lock() # Guards the attributes below
+        self.refresh_lock = threading.Lock() # One refresh at a time
+        self.cookie = None
+        self.updated = 0
+        self.refreshing = False
+        self.retry_at = 0
+
+    def get(self):
+        with self.lock:
+            now = time.time()
+            age = now - self.updated
+            if self.cookie is not None and age < ROT_TIME:
+                if (age > ROT_TIME - self.refresh_ahead and not self.refreshing
+                        and now >= self.retry_at):
+                    self.refreshing = True
+                    thread = threading.Thread(target=self.refresh_in_background)
+                    thread.daemon = True
+                    thread.start()
+                return self.cookie
+        return self.refresh(0)
+
+    def reauthenticate(self, rejected):
+        """A cookie newer than the rejected one"""
+        with self.lock:
+            min_update = self.updated + 1 if rejected is self.cookie else self.updated
+        return self.refresh(min_update)
+
+    def refresh(self, min_update):
+        """Use the cookie stored at or after min_update, if still valid, or
+        get a new one"""
+        with self.refresh_lock:
+            with self.lock:
+                if (self.cookie is not None and self.updated >= min_update and
+                        time.time() - self.updated < ROT_TIME):
+                    return self.cookie # Refreshed while waiting for the lock
+
+            with file_lock(self.lockpath):
+                manager = CookieManager(self.workdir)
+                try:
+                    stored = manager.stored_cookie(self.url)
+                    if (stored and stored[0] >= min_update and
+                            time.time() - stored[0] < ROT_TIME):
+                        updated, cookie = stored
+                    else:
+                        logging.info("Getting a new SSO cookie for %s" % self.url)
+                        cookie = manager.get_new_cookie(self.url, self.use_certs)
+                        updated = int(time.time())
+                finally:
+                    manager.close()
+
+            with self.lock:
+                self.cookie, self.updated = cookie, updated
+            return cookie
+
+    def refresh_in_background(self):
+        try:
+            self.refresh(int(time.time()) - ROT_TIME + self.refresh_ahead)
+        except Exception as e:
+            logging.warning("Background SSO cookie refresh failed, retrying in %ds: %s" %
+                            (RETRY_DELAY, e))
+            with self.lock:
+                self.retry_at = time.time() + RETRY_DELAY
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def shared_provider(workdir, url, use_certs = True):
+    """The process wide CookieProvider of a cookie DB and URL"""
+    with _providers_lock:
+        key = (workdir, url, use_certs)
+        if key not in _providers:
+            _providers[key] = CookieProvider(workdir, url, use_certs)
+        return _providers[key]
@@ -0,0 +1,148 @@
+"""Columnar partition writers for the export subcommand.
+
+A partition holds the rows of one dataset for one run and lumiblock and is
+written from chunks of row tuples, so the whole table never has to be in
+memory. String columns are dictionary encoded: NPZ partitions store an
+int32 code array plus a "<column>_dictionary" array, Parquet partitions use
+Arrow dictionary columns.
+"""
+import os
+import shutil
+import zipfile
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+pa = pq = None # pyarrow is slow to import, loaded by the parquet writer
+
+STRING_COLUMNS = ("entity_name", "var_name", "ros_name")
+INTEGER_COLUMNS = ("t", "channel")
+
+
+def partition_path(outdir, dataset, run_number, lumiblock, extension):
+    return os.path.join(outdir, dataset, "run=%d" % run_number,
+                        "lumiblock=%d%s" % (lumiblock, extension))
+
+
+class DictionaryEncoder(object):
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, values):
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+            codes[i] = code
+        return codes
+
+
+class NpzPartitionWriter(object):
+    """Compressed NPZ, one array per column. np.load reads the columns of
+    an NPZ lazily, one at a time. The chunks are appended to a raw file per
+    column and only zipped as .npy members on close."""
+    extension = ".npz"
+
+    def __init__(self, path, columns):
+        if np is None:
+            raise Exception("The npz export needs NumPy")
+        self.path = path
+        self.columns = columns
+        self.tmpdir = tempfile.mkdtemp(dir=os.path.dirname(path) or ".")
+        self.files = dict((column, open(os.path.join(self.tmpdir, column), "wb"))
+                          for column in columns)
+        self.dtypes = {}
+        self.lengths = dict((column, 0) for column in columns)
+        self.encoders = dict((column, DictionaryEncoder())
+                             for column in columns if column in STRING_COLUMNS)
+
+    def write(self, rows):
+        for column, values in zip(self.columns, zip(*rows)):
+            if column in self.encoders:
+                array = self.encoders[column].encode(values)
+            elif column in INTEGER_COLUMNS:
+                array = np.array(values, dtype=np.int64)
+            else:
+                array = np.array(values, dtype=float)
+            self.dtypes[column] = array.dtype
+            self.lengths[column] += len(array)
+            self.files[column].write(array.tobytes())
+
+    def add_member(self, archive, name, dtype, length, data):
+        """Zip a raw data file as name.npy"""
+        member = os.path.join(self.tmpdir, name + ".npy")
+        with open(member, "wb") as out:
+            np.lib.format.write_array_header_1_0(out, {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": False, "shape": (length,)})
+            with open(data, "rb") as raw:
+                shutil.copyfileobj(raw, out)
+        archive.write(member, name + ".npy")
+        os.remove(member)
+
+    def close(self):
+        try:
+            with zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED,
+                                 allowZip64=True) as archive:
+                for column in self.columns:
+                    self.files[column].close()
+                    dtype = self.dtypes.get(column, np.dtype(
+                        np.int32 if column in self.encoders else
+                        np.int64 if column in INTEGER_COLUMNS else float))
+                    self.add_member(archive, column, dtype, self.lengths[column],
+                                    self.files[column].name)
+                    if column in self.encoders:
+                        dictionary = np.array(self.encoders[column].values)
+                        data = os.path.join(self.tmpdir, column + "_dictionary")
+                        with open(data, "wb") as raw:
+                            raw.write(dictionary.tobytes())
+                        self.add_member(archive, column + "_dictionary",
+                                        dictionary.dtype, len(dictionary), data)
+        finally:
+            shutil.rmtree(self.tmpdir)
+
+
+class ParquetPartitionWriter(object):
+    """Parquet, one row group per chunk, dictionary encoded strings"""
+    extension = ".parquet"
+
+    def __init__(self, path, columns):
+        global pa, pq
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("The parquet export needs pyarrow")
+        self.path = path
+        self.columns = columns
+        self.writer = None
+
+    def write(self, rows):
+        arrays = []
+        for column, values in zip(self.columns, zip(*rows)):
+            if column in STRING_COLUMNS:
+                arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+            elif column in INTEGER_COLUMNS:
+                arrays.append(pa.array(values, type=pa.int64()))
+            else:
+                arrays.append(pa.array(values, type=pa.float64(), from_pandas=True))
+        table = pa.Table.from_arrays(arrays, names=list(self.columns))
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression="zstd")
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {
+    "npz": NpzPartitionWriter,
+    "parquet": ParquetPartitionWriter,
+}
@@ -0,0 +1,113 @@
+"""Retries and adaptive concurrency for the PBeast queries.
+
+A FetchController runs every readSeries request of a process. Requests
+that time out, lose their connection or get a 429 or 5xx answer are tried
+again after a jittered exponential backoff, honouring Retry-After. How
+many requests may be in flight is an AIMD limit: it grows by about one per
+round of healthy answers, answers slower than latency_target stop the
+growth and every failure halves it, at most once per backoff period so a
+burst of failures from the same overload counts as one.
+"""
+import time
+import random
+import logging
+import threading
+import contextlib
+
+import metrics
+
+RETRIES = 4
+BACKOFF = 1.0 # Seconds before the first retry, doubled for every next one
+MAX_BACKOFF = 60.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+INITIAL_CONCURRENCY = 4
+LATENCY_TARGET = 30.0 # Seconds, slower answers stop the limit growth
+
+
+class FetchController(object):
+    def __init__(self, max_concurrency=10, initial_concurrency=INITIAL_CONCURRENCY,
+                 retries=RETRIES, backoff=BACKOFF, latency_target=LATENCY_TARGET):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(min(initial_concurrency, self.max_concurrency))
+        self.retries = retries
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Wait until a request fits under the limit"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def succeeded(self, seconds):
+        with self.condition:
+            if seconds <= self.latency_target:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def failed(self):
+        with self.condition:
+            now = time.time()
+            if now - self.last_decrease < self.backoff:
+                return
+            self.last_decrease = now
+            self.limit = max(1.0, self.limit / 2)
+        logging.info("PBeast concurrency limit lowered to %d" % int(self.limit))
+        metrics.registry.count("pbeast_concurrency_decreases")
+
+    def delay(self, attempt, error):
+        """Full jitter backoff, at least what a 429 asked for"""
+        delay = random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+        retry_after = getattr(getattr(error, "response", None), "headers", {}).get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(MAX_BACKOFF, float(retry_after)))
+        return delay
+
+    def call(self, request):
+        """Return request(), trying it again while it fails in a retryable
+        way. request must have read what it needs of the answer, so its
+        latency and failures are seen here."""
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                with self.slot():
+                    result = request()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.failed()
+                if attempt >= self.retries:
+                    raise
+                delay = self.delay(attempt, e)
+                attempt += 1
+                logging.warning("PBeast request failed (%s), retry %d of %d in %.1fs" %
+                                (e, attempt, self.retries, delay))
+                metrics.registry.count("pbeast_retries")
+                time.sleep(delay)
+                continue
+            self.succeeded(time.time() - start)
+            return result
+
+
+def is_retryable(error):
+    """Timeouts, connection errors and overload answers, not the queries
+    PBeast refuses"""
+    import requests
+    if isinstance(error, requests.exceptions.HTTPError):
+        return (error.response is not None and
+                error.response.status_code in RETRY_STATUS)
+    return isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
@@ -1,30 +1,495 @@
-from cernsso import cookie
-import requests
-cm = cookie.CookieManager("/tmp") # Sqlite3 db with cookie will be saved there.
-cookies = cm.get_new_cookie("https://atlasop.cern.ch/operation.php", use_certs=False)
+import re
+import time
+import json
+import codecs
+import logging
+import collections
+import operator
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+
+import metrics
+import fetch_control
+
+PBEAST_URL = "https://atlasop.cern.ch/tdaq/pbeast/readSeries"
+SSO_URL = "https://atlasop.cern.ch/operation.php"
+COOKIE_WORKDIR = "/tmp" # Sqlite3 db with cookie will be saved there.
+CLOSED_WINDOW_MARGIN = 600 # Seconds after etime before a window is final
+MAX_DATA_POINTS = 5000 # Per series, PBeast downsamples above it
+PROBE_SECONDS = 300 # Window used to estimate the point density of a query
+PLAN_FILL = 0.5 # Fraction of MAX_DATA_POINTS planned per sub-window
+SATURATION = 0.95 # Fraction of MAX_DATA_POINTS seen as a downsampled answer
+CHUNK_SIZE = 64 * 1024
+
+
+class PBeastClient(object):
+    """Keep-alive client for the PBeast readSeries service.
+
+    Every query goes through one pooled requests.Session, so the TCP+TLS
+    handshake is paid once per pooled connection instead of once per call.
+    The SSO cookie comes from the process wide cernsso CookieProvider,
+    first asked right before the first query that actually reaches the
+    network. If PBeast rejects it (401 or a redirect to the SSO login) the
+    query authenticates again and is retried once.
+
+    With a ResponseCache, responses for closed windows are served from disk.
+    refresh skips the lookups but still stores what is downloaded.
+
+    Without sso no cookie is ever loaded, for servers outside CERN SSO like
+    the pbeast_standin one.
+
+    Requests go through a fetch_control.FetchController, which retries
+    the failed ones and keeps at most pool_size, and fewer while PBeast is
+    overloaded, in flight.
+    """
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=300,
+                 url=PBEAST_URL, cookie_workdir=COOKIE_WORKDIR, cache=None,
+                 refresh=False, sso=True, retries=fetch_control.RETRIES,
+                 initial_concurrency=fetch_control.INITIAL_CONCURRENCY):
+        self.url = url
+        self.sso = sso
+        self.timeout = (connect_timeout, read_timeout)
+        self.cookie_workdir = cookie_workdir
+        self.cache = cache
+        self.refresh = refresh
+        self.controller = fetch_control.FetchController(pool_size,
+                initial_concurrency, retries)
+
+        # Imported with the first client, local commands never need them
+        import requests
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate",
+                                     "Connection": "keep-alive"})
+        self.session.verify = False
+
+    def cookie_provider(self):
+        from cernsso import cookie
+        return cookie.shared_provider(self.cookie_workdir, SSO_URL, use_certs=False)
+
+    def request(self, parameters, stream=False):
+        """GET readSeries with the SSO cookie, authenticating again once if
+        PBeast does not accept it"""
+        cookies = self.cookie_provider().get() if self.sso else None
+        response = self.session.get(self.url, params=parameters, cookies=cookies,
+                                    timeout=self.timeout, stream=stream,
+                                    allow_redirects=False)
+        if self.sso and is_rejected(response):
+            response.close()
+            logging.warning("PBeast answered %d, authenticating again" %
+                            response.status_code)
+            metrics.registry.count("pbeast_reauthentications")
+            cookies = self.cookie_provider().reauthenticate(cookies)
+            response = self.session.get(self.url, params=parameters, cookies=cookies,
+                                        timeout=self.timeout, stream=stream,
+                                        allow_redirects=False)
+        if is_rejected(response):
+            response.close()
+            raise Exception("PBeast answered %d, the SSO cookie was not accepted" %
+                            response.status_code)
+        response.raise_for_status()
+        return response
+
+    def parameters(self, **kwargs):
+        id_str = ".".join([kwargs['partition'], kwargs['typ3'],
+                           kwargs['attrib'], kwargs['server'],
+                           kwargs['object_regxp']])
+        return {
+            "id": id_str,
+            "maxDataPoints": str(kwargs.get('max_data_points') or MAX_DATA_POINTS),
+            "plotType": "line",
+            "to": int(kwargs['etime']),
+            "from": int(kwargs['stime']),
+        }
+
+    def get(self, *args, **kwargs):
+        parameters = self.parameters(**kwargs)
+
+        key = self.cache_key(parameters)
+        if key is not None and not self.refresh:
+            text = self.cache.load(key)
+            if text is not None:
+                metrics.registry.count("pbeast_cache_hits")
+                return text
+
+        def request():
+            response = self.request(parameters)
+            return response, response.text
+
+        with metrics.registry.timed("pbeast_request"):
+            response, text = self.controller.call(request)
+        metrics.registry.count("pbeast_bytes", wire_bytes(response, len(response.content)))
+
+        if key is not None:
+            self.cache.store(key, text)
+        return text
+
+    def stream(self, *args, **kwargs):
+        """Return the readSeries answer as an iterator of text chunks, so
+        the body is never held whole in memory"""
+        parameters = self.parameters(**kwargs)
+
+        key = self.cache_key(parameters)
+        if key is not None and not self.refresh:
+            chunks = self.cache.reader(key)
+            if chunks is not None:
+                metrics.registry.count("pbeast_cache_hits")
+                return decode_chunks(chunks)
+
+        # Only up to the headers, the body is read while it is parsed and
+        # a connection lost after that is not retried
+        with metrics.registry.timed("pbeast_request"):
+            response = self.controller.call(
+                    lambda: self.request(parameters, stream=True))
+        chunks = iter_response(response)
+
+        if key is not None:
+            chunks = self.cache.writer(key, chunks)
+        return decode_chunks(chunks)
+
+    def iter_points(self, split=False, split_workers=4, **kwargs):
+        """Yield the (label, datapoint) pairs of the readSeries answer as
+        they are decoded from the HTTP body"""
+        if split:
+            # Split answers have to be seen whole to be bisected and merged
+            return iter_labelled(self.get_series(split, split_workers, **kwargs))
+        return iter_datapoints(self.stream(**kwargs))
+
+    def get_series(self, split=False, split_workers=4, **kwargs):
+        """Return the parsed readSeries answer for the query.
+
+        With split, the [stime, etime] window is cut into sub-windows that
+        each stay under MAX_DATA_POINTS per series, so long windows come back
+        at full resolution. The point density is estimated from a first probe
+        window, the rest is fetched by split_workers threads and every
+        sub-window that still looks downsampled is bisected again.
+        """
+        if not split:
+            return json.loads(self.get(**kwargs))
+
+        stime = int(kwargs['stime'])
+        etime = int(kwargs['etime'])
+
+        probe_end = min(etime, stime + PROBE_SECONDS)
+        while True:
+            probe = json.loads(self.get(**dict(kwargs, stime=stime, etime=probe_end)))
+            if not is_saturated(probe) or probe_end - stime <= 1:
+                break
+            probe_end = stime + max(1, (probe_end - stime) // 10)
+
+        density = float(densest(probe)) / max(1, probe_end - stime)
+        windows = plan_windows(probe_end, etime, density)
+        logging.debug("Splitting %s into %d windows" % (kwargs['attrib'], len(windows) + 1))
+
+        responses = [probe]
+        if windows:
+            pool = ThreadPool(min(split_workers, len(windows)))
+            try:
+                fetch = lambda window: self.get_window(window, **kwargs)
+                for window_responses in pool.map(fetch, windows):
+                    responses.extend(window_responses)
+            finally:
+                pool.close()
+                pool.join()
+        return merge_series(responses)
+
+    def get_window(self, window, **kwargs):
+        """Fetch the (stime, etime) window, bisecting it while the answer
+        is downsampled"""
+        stime, etime = window
+        response = json.loads(self.get(**dict(kwargs, stime=stime, etime=etime)))
+        if not is_saturated(response) or etime - stime <= 1:
+            return [response]
+        middle = stime + (etime - stime) // 2
+        metrics.registry.count("pbeast_window_splits")
+        return (self.get_window((stime, middle), **kwargs) +
+                self.get_window((middle, etime), **kwargs))
+
+    def get_coalesced(self, queries, merge_ids=False):
+        """Answer several queries that only differ by attribute, in order.
+
+        By default they go out as one concurrent burst over the keep-alive
+        pool, each answer as get_series or iter_points would return it.
+        With merge_ids they are sent as a single readSeries call with an
+        (attr1|attr2) attribute regexp, and its series are handed back to
+        each query by the attribute in their label.
+
+        Return an (answer, error) pair per query: a query of the burst that
+        fails does not lose the answers of the others.
+        """
+        stream = queries[0].get('stream', False)
+        if merge_ids:
+            attribs = [query['attrib'] for query in queries]
+            merged = dict(queries[0], attrib="(%s)" % "|".join(attribs))
+            by_attrib = dict((attrib, []) for attrib in attribs)
+            for series in self.get_series(**merged):
+                attrib = series['label'].split('.')[2]
+                if attrib in by_attrib:
+                    by_attrib[attrib].append(series)
+            answers = [by_attrib[attrib] for attrib in attribs]
+            if stream:
+                answers = [iter_labelled(answer) for answer in answers]
+            return [(answer, None) for answer in answers]
+
+        fetch = self.iter_points if stream else self.get_series
+        def attempt(query):
+            try:
+                return fetch(**query), None
+            except Exception as e:
+                return None, e
+
+        pool = ThreadPool(len(queries))
+        try:
+            return pool.map(attempt, queries)
+        finally:
+            pool.close()
+            pool.join()
+
+    def cache_key(self, parameters):
+        if self.cache is not None and self.is_closed(parameters):
+            return self.cache.key(self.url, parameters)
+        return None
+
+    def is_closed(self, parameters):
+        """Only windows that ended a while ago are final and safe to cache"""
+        return int(parameters['to']) < time.time() - CLOSED_WINDOW_MARGIN
+
+
+def is_rejected(response):
+    """An expired SSO session gets a 401 or a redirect to the login page"""
+    return response.status_code in (301, 302, 303, 307, 401)
+
+
+def densest(response):
+    return max([len(series['datapoints']) for series in response] or [0])
+
+
+def is_saturated(response):
+    return densest(response) >= MAX_DATA_POINTS * SATURATION
+
+
+def plan_windows(stime, etime, density):
+    """Split [stime, etime] in windows of PLAN_FILL * MAX_DATA_POINTS points
+    for a series with the given points per second"""
+    if stime >= etime:
+        return []
+    if density > 0:
+        span = max(1, int(MAX_DATA_POINTS * PLAN_FILL / density))
+    else:
+        span = etime - stime
+
+    windows = []
+    start = stime
+    while start < etime:
+        end = min(etime, start + span)
+        windows.append((start, end))
+        start = end
+    return windows
+
+
+def merge_series(responses):
+    """Merge readSeries answers for consecutive windows into one answer,
+    each series sorted by timestamp and without the points repeated at the
+    window boundaries"""
+    merged = collections.OrderedDict()
+    for response in responses:
+        for series in response:
+            datapoints = merged.setdefault(series['label'], [])
+            datapoints.extend(series['datapoints'])
+
+    result = []
+    for label, datapoints in merged.items():
+        datapoints.sort(key=operator.itemgetter(0))
+        unique = []
+        for d in datapoints:
+            if not unique or unique[-1][0] != d[0]:
+                unique.append(d)
+        result.append({"label": label, "datapoints": unique})
+    return result
+
+
+def coalesce_key(query):
+    """Queries with the same key only differ by attribute"""
+    return tuple(sorted((key, value) for key, value in query.items()
+                        if key != 'attrib'))
+
+
+def iter_series(points, size):
+    """Group (label, datapoint) pairs into (label, datapoints) runs of at
+    most size consecutive points of the same series"""
+    for label, run in itertools.groupby(points, operator.itemgetter(0)):
+        while True:
+            datapoints = [d for _, d in itertools.islice(run, size)]
+            if not datapoints:
+                break
+            yield label, datapoints
+
+
+def wire_bytes(response, decoded):
+    """Bytes read off the connection, before any Content-Encoding is
+    undone, or the decoded size when the transport does not tell"""
+    try:
+        return int(response.raw.tell())
+    except (AttributeError, TypeError, ValueError):
+        return decoded
+
+
+def iter_response(response):
+    size = 0
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            yield chunk
+    finally:
+        metrics.registry.count("pbeast_bytes", wire_bytes(response, size))
+        response.close()
+
+
+def decode_chunks(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_labelled(response):
+    for series in response:
+        for d in series['datapoints']:
+            yield series['label'], d
+
+
+class StreamReader(object):
+    """Pull JSON values one at a time out of an iterator of text chunks"""
+    SKIP = re.compile(r'[\s,]*')
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.buf = u""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.pos > CHUNK_SIZE:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        try:
+            self.buf += next(self.chunks)
+        except StopIteration:
+            self.eof = True
+
+    def drain(self):
+        """Consume the trailing chunks, letting cache writers commit"""
+        for _ in self.chunks:
+            pass
+        self.eof = True
+
+    def peek(self):
+        """Next significant character, separators skipped"""
+        while True:
+            self.pos = self.SKIP.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Truncated readSeries answer")
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected %r at offset %d of the readSeries answer" %
+                             (char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number that ends with the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_datapoints(chunks):
+    """Incrementally parse a readSeries answer, [{"label": ..., "datapoints":
+    [[t, value], ...]}, ...], yielding (label, datapoint) pairs as soon as
+    each datapoint array is decoded"""
+    reader = StreamReader(chunks)
+    reader.expect('[')
+    while reader.peek() != ']':
+        reader.expect('{')
+        label = None
+        pending = [] # Datapoints seen before the label, if any
+        while reader.peek() != '}':
+            key = reader.value()
+            reader.expect(':')
+            if key != 'datapoints':
+                value = reader.value()
+                if key == 'label':
+                    label = value
+                    for d in pending:
+                        yield label, d
+                    pending = []
+                continue
+
+            reader.expect('[')
+            while reader.peek() != ']':
+                d = reader.value()
+                if label is None:
+                    pending.append(d)
+                else:
+                    yield label, d
+            reader.expect(']')
+        reader.expect('}')
+    reader.drain()
+
+
+_client = None
+_client_settings = {}
+_client_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Set the PBeastClient options used by get(). The client itself is
+    only built on the first query."""
+    global _client, _client_settings
+    with _client_lock:
+        _client_settings = kwargs
+        _client = None
+
+
+def client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = PBeastClient(**_client_settings)
+        return _client
+
 
 def get(*args, **kwargs):
+    return client().get(*args, **kwargs)
+
+
+def get_series(*args, **kwargs):
+    return client().get_series(*args, **kwargs)
+
 
-    stime = kwargs['stime']
-    etime = kwargs['etime']
-    partition = kwargs['partition']
-    typ3 = kwargs['typ3']
-    server = kwargs['server']
-    attrib = kwargs['attrib']
-    object_regxp = kwargs['object_regxp']
-    
-    id_str = ".".join([partition, typ3, attrib, server, object_regxp])
-
-    parameters = {
-        "id": id_str,
-        "maxDataPoints": "5000",
-        "plotType": "line",
-        "to": etime,
-        "from": stime,
-    }
-    response = requests.get("https://atlasop.cern.ch/tdaq/pbeast/readSeries",
-                            cookies = cookies, verify=False, params = parameters)
-
-    return response.text
+def iter_points(*args, **kwargs):
+    return client().iter_points(*args, **kwargs)
 
 
+def get_coalesced(*args, **kwargs):
+    return client().get_coalesced(*args, **kwargs)
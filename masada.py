@@ -1,15 +1,30 @@
 #!/usr/bin/env python2.7
 import get_pbeast_data
+import pbeast_cache
+import columnar_export
+import tsstore
+import aggregates
+import metrics
 import sys
 import os
 from peewee import *
 import json
+import sqlite3
 from sqlite3 import OperationalError, IntegrityError
 import logging
+import time
 import argparse
-import dateutil.parser
 import copy
-import argparse
+import shlex
+import subprocess
+import collections
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 root = logging.getLogger()
@@ -22,12 +37,137 @@ ch.setFormatter(formatter)
 root.addHandler(ch)
 
 DB_FILE = os.path.abspath('pbeast_data_report.db')
-db = SqliteDatabase(DB_FILE)
+STORE_DIR = os.path.abspath('pbeast_series_store')
+
+
+class MasadaDatabase(SqliteDatabase):
+    """SqliteDatabase that runs the session pragmas on every new connection"""
+    session_pragmas = ()
+
+    def _connect(self, database, **kwargs):
+        conn = super(MasadaDatabase, self)._connect(database, **kwargs)
+        for name, value in self.session_pragmas:
+            conn.execute("PRAGMA %s = %s" % (name, value))
+        return conn
+
+
+db = MasadaDatabase(DB_FILE)
+BATCH_SIZE = 100 # Rows per INSERT, 8 columns per row stays under SQLite's 999 variables
+BULK_BATCH_SIZE = 10000 # Rows per executemany call of the bulk loader
+EXPORT_BATCH_SIZE = 100000 # Rows read from SQLite per exported chunk
+INGEST_PRAGMAS = (
+        ("synchronous", "NORMAL"), # With WAL, only checkpoints fsync
+        ("cache_size", -256 * 1024), # 256 MB of page cache
+        ("mmap_size", 1024 ** 3),
+        ("temp_store", "MEMORY"),
+        )
+
+
+def batches(iterable, size):
+    """Yield lists of up to size items from any iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+class BulkLoader(object):
+    """Insert plain tuples into a model table with sqlite3 executemany.
+
+    This skips peewee's per-row dict handling and field conversions (the
+    Decimal round trip of DecimalField columns). executemany binds one row
+    at a time to a single prepared statement, so SQLite's variable limit
+    never applies; rows are consumed in chunks to keep memory bounded.
+    The caller owns the transaction.
+    """
+    def __init__(self, model, columns):
+        fields = model._meta.fields
+        db_columns = ['"%s"' % fields[name].db_column for name in columns]
+        self.sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
+                model._meta.db_table, ", ".join(db_columns),
+                ", ".join("?" * len(columns)))
+
+    def load(self, rows, batch_size=BULK_BATCH_SIZE):
+        conn = db.get_conn()
+        inserted = 0
+        for batch in batches(rows, batch_size):
+            conn.executemany(self.sql, batch)
+            inserted += len(batch)
+        return inserted
+
+
+class FastIngest(object):
+    """Ingest profile for the duration of a retrieve.
+
+    Switches the DB to WAL with relaxed synchronous, a large page cache and
+    mmap on every connection, and drops the non unique secondary indexes of
+    the loaded tables, rebuilding them once the load is over. The dropped
+    indexes are recorded in DeferredIndexModel first, so an interrupted
+    ingest gets them rebuilt by the next one. On exit the durable rollback
+    journal is restored.
+    """
+    def __init__(self, models):
+        self.tables = [model._meta.db_table for model in models]
+
+    def __enter__(self):
+        # Kept open for the whole ingest so WAL is not checkpointed and
+        # reset every time a lumiblock insert closes its connection
+        self.conn = sqlite3.connect(db.database)
+        self.conn.isolation_level = None
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        db.session_pragmas = INGEST_PRAGMAS
+        if not db.is_closed():
+            db.close()
+
+        DeferredIndexModel.create_table(fail_silently=True)
+        self.rebuild_indexes()
+        self.drop_indexes()
+        return self
+
+    def __exit__(self, *exc_info):
+        db.session_pragmas = ()
+        if not db.is_closed():
+            db.close()
+        try:
+            self.rebuild_indexes()
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            self.conn.close()
+
+    def drop_indexes(self):
+        placeholders = ", ".join("?" * len(self.tables))
+        indexes = self.conn.execute("""SELECT name, sql FROM sqlite_master
+                WHERE type = 'index' AND sql IS NOT NULL
+                AND sql NOT LIKE 'CREATE UNIQUE%%' AND tbl_name IN (%s)"""
+                % placeholders, self.tables).fetchall()
+
+        table = DeferredIndexModel._meta.db_table
+        self.conn.execute("BEGIN")
+        for name, sql in indexes:
+            self.conn.execute('INSERT INTO "%s" (name, sql) VALUES (?, ?)' % table,
+                    (name, sql))
+            self.conn.execute('DROP INDEX "%s"' % name)
+        self.conn.execute("COMMIT")
+        logging.info("Deferred %d indexes until the end of the ingest" % len(indexes))
+
+    def rebuild_indexes(self):
+        table = DeferredIndexModel._meta.db_table
+        indexes = self.conn.execute('SELECT name, sql FROM "%s"' % table).fetchall()
+        for name, sql in indexes:
+            logging.info("Building index %s" % name)
+            self.conn.execute("BEGIN")
+            self.conn.execute(sql)
+            self.conn.execute('DELETE FROM "%s" WHERE name = ?' % table, (name, ))
+            self.conn.execute("COMMIT")
+
 
 class InitializeAction(object):
     def __init__(self):
-        if os.path.isfile(DB_FILE):
-            os.remove(DB_FILE)
+        if os.path.isfile(db.database):
+            os.remove(db.database)
         self.create_tables()
 
     def create_tables(self):
@@ -35,6 +175,7 @@ class InitializeAction(object):
 
         tables = [klass for klass in BaseModel.__subclasses__()]
         db.create_tables(tables)
+        create_normalized_schema()
         db.close() 
         
 
@@ -50,7 +191,39 @@ class BaseModel(Model):
 
 class DatasetRetrieveAction(): 
     def __init__(self, namespace):
+        namespace['datasets'] = select_datasets(namespace['dataset'],
+                namespace['profile'])
+
+        cache = None
+        if namespace['use_cache']:
+            cache = pbeast_cache.ResponseCache(namespace['cache_dir'],
+                    namespace['cache_size'] * 1024 ** 2)
+        # A worker has up to one query per dataset in flight when coalescing
+        get_pbeast_data.configure(
+                pool_size=max(namespace['pool_size'],
+                    namespace['workers'] * len(namespace['datasets'])),
+                read_timeout=namespace['timeout'],
+                cache=cache, refresh=namespace['refresh'],
+                url=namespace['pbeast_url'], sso=namespace['sso'],
+                retries=namespace['retries'],
+                initial_concurrency=namespace['initial_concurrency'])
+        FailedWindowModel.create_table(fail_silently=True)
+
+        if namespace['fast_ingest']:
+            models = PBEAST_MODELS
+            if namespace['backend'] == 'normalized':
+                models = list(NORMALIZED_MODELS.values())
+            with FastIngest(models):
+                self.dispatch(namespace)
+        else:
+            self.dispatch(namespace)
+
+        for line in metrics.registry.summary():
+            logging.info(line)
+        if namespace['metrics_out']:
+            metrics.registry.write(namespace['metrics_out'], namespace['metrics_format'])
 
+    def dispatch(self, namespace):
         is_single = namespace['single']
 
         if is_single:
@@ -59,47 +232,768 @@ class DatasetRetrieveAction():
             self.multiple_dispatch(namespace)
 
     def multiple_dispatch(self, namespace):
-        ds_class_name = namespace['dataset']
-        obj = None
-        klass = None
-        if ds_class_name in datasets:
-            klass = getattr(sys.modules[__name__], ds_class_name)
+        klasses = [getattr(sys.modules[__name__], ds_class_name)
+                for ds_class_name in namespace['datasets']]
+        lumiblocks = list(LumiBlockModel.select().where(
+            LumiBlockModel.run_number==namespace['run_number']))
+
+        jobs = []
+        for klass in klasses:
+            name = ledger_name(klass.__name__, namespace)
+            done = ingested_windows(name, namespace['run_number'])
+            if namespace['replay_failed']:
+                replayed = failed_windows(name, namespace['run_number'])
+                logging.info("Replaying %d failed lumiblocks of %s" %
+                        (len(replayed - done), klass.__name__))
+            skipped = 0
+            for lumi in lumiblocks:
+                window = (int(lumi.lumiblock), int(lumi.stime), int(lumi.etime))
+                if window in done:
+                    skipped += 1
+                    continue
+                if namespace['replay_failed'] and window not in replayed:
+                    continue
+                input_params = copy.copy(namespace)
+                input_params['stime'] = lumi.stime
+                input_params['etime'] = lumi.etime
+                input_params['lumiblock'] = lumi.lumiblock
+                jobs.append(klass(**input_params))
+            logging.info("%d of %d lumiblocks of %s already ingested, skipping them" %
+                    (skipped, len(lumiblocks), klass.__name__))
+
+        # Lumiblock major, so all the datasets advance through the run together
+        jobs.sort(key=lambda data_set: data_set.parsed_params['lumiblock'])
+        if namespace['coalesce']:
+            groups = coalesce(jobs)
+        else:
+            groups = [[data_set] for data_set in jobs]
+
+        workers = namespace.get('workers') or 1
+        failed = 0
+        for group in self.fetch_all(groups, workers, namespace['coalesce_ids']):
+            for data_set in group:
+                if data_set.fetch_error is not None:
+                    record_failure(data_set, data_set.fetch_error)
+                    failed += 1
+                    continue
+                try:
+                    # With --stream the body is only downloaded and parsed here
+                    self.run_stage(data_set, "insert")
+                except Exception as e:
+                    record_failure(data_set, e)
+                    failed += 1
+                    continue
+                logging.info("Data object %s stored" % data_set.__class__.__name__)
+        if failed:
+            logging.warning("%d lumiblock windows could not be retrieved, "
+                    "retrieve them again with --replay-failed" % failed)
+
+    def fetch(self, group, merge_ids=False):
+        """Run the network bound stages of a group of datasets: everything
+        but insert. The PBeast queries of a group only differ by attribute
+        and go out together.
+
+        A dataset whose request still fails once out of retries gets its
+        fetch_error set, and is recorded for replay instead of ending the
+        run. The other datasets of its group are stored as usual."""
+        try:
+            if len(group) > 1:
+                names = "+".join(data_set.__class__.__name__ for data_set in group)
+                with metrics.registry.timed("stage", stage="get_data", dataset=names):
+                    PBeastDSMethods.get_data_coalesced(group, merge_ids)
+            else:
+                self.run_stage(group[0], "get_data")
+        except Exception as e:
+            # A merged readSeries call is the one request of all the group
+            for data_set in group:
+                data_set.fetch_error = e
+        for data_set in group:
+            if data_set.fetch_error is not None:
+                continue
+            try:
+                self.run_stage(data_set, "parse_input")
+                self.run_stage(data_set, "transform")
+            except Exception as e:
+                data_set.fetch_error = e
+        return group
+
+    def run_stage(self, data_set, stage):
+        """Run and time one stage. With --stream the stages are lazy and the
+        download, parsing and transform are timed as part of insert."""
+        with metrics.registry.timed("stage", stage=stage,
+                dataset=data_set.__class__.__name__):
+            getattr(data_set, stage)()
+
+    def fetch_all(self, groups, workers=1, merge_ids=False):
+        """Yield the fetched groups of datasets, in the same order as groups.
+
+        With more than one worker the PBeast fetches overlap in a thread
+        pool, keeping at most 2 * workers lumiblocks in flight so memory
+        stays bounded. The caller remains the only DB writer.
+        """
+        if workers <= 1:
+            for group in groups:
+                yield self.fetch(group, merge_ids)
+            return
+
+        pool = ThreadPool(workers)
+        pending = collections.deque()
+        try:
+            for group in groups:
+                pending.append(pool.apply_async(self.fetch, (group, merge_ids)))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.close()
+            pool.join()
 
-        l_input_params = []
-        for lumi in LumiBlockModel.select().where(LumiBlockModel.run_number==namespace['run_number']):
-            input_params = copy.copy(namespace)
-            input_params['stime'] = lumi.stime
-            input_params['etime'] = lumi.etime
-            input_params['lumiblock'] = lumi.lumiblock
-            l_input_params.append(input_params)
+    def single_dispatch(self, namespace):
+        for ds_class_name in namespace['datasets']:
+            klass = getattr(sys.modules[__name__], ds_class_name)
 
+            input_params = namespace
 
-        for input_params in l_input_params: 
             data_set = klass(**input_params)
-            data_set.get_data()
-            data_set.parse_input()
-            data_set.transform()
-            data_set.insert()
+            for stage in ("get_data", "parse_input", "transform", "insert"):
+                self.run_stage(data_set, stage)
             logging.info("Data object %s stored" % ds_class_name)
 
-    def single_dispatch(self, namespace):
-        ds_class_name = namespace['dataset']
-        obj = None
-        klass = None
-        if ds_class_name in datasets:
+
+class SQLiteBackend(object):
+    """Rows of a PBeast dataset in its peewee model table"""
+    def insert(self, data_set):
+        params = data_set.parsed_params
+        if params['bulk']:
+            models = data_set.models
+            if params['columnar']:
+                models = itertools.chain.from_iterable(models)
+            loader = BulkLoader(data_set.model, data_set.datasource.columns)
+            return loader.load(models, params['batch_size'] or BULK_BATCH_SIZE)
+
+        rows = 0
+        for batch in batches(data_set.models, params['batch_size'] or BATCH_SIZE):
+            data_set.model.insert_many(batch).execute()
+            rows += len(batch)
+        return rows
+
+
+class SeriesStoreBackend(object):
+    """Rows of a PBeast dataset in a tsstore.SeriesStore, one series per
+    combination of the columns that are neither lumiblock, time nor value"""
+    value_columns = ("min_req", "req", "max_req")
+
+    def __init__(self, store_dir):
+        self.store = tsstore.SeriesStore(store_dir)
+
+    def insert(self, data_set):
+        params = data_set.parsed_params
+        ds_class_name = data_set.__class__.__name__
+        run_number = int(params['run_number'])
+        lumiblock = int(params['lumiblock'])
+        if self.store.has_lumiblock(ds_class_name, run_number, lumiblock):
+            logging.info("Lumiblock %d of %s already in the series store" %
+                    (lumiblock, ds_class_name))
+            return 0
+
+        columns = data_set.datasource.columns
+        t_index = columns.index("t")
+        value_indexes = [i for i, column in enumerate(columns)
+                if column in self.value_columns]
+        key_indexes = [i for i, column in enumerate(columns)
+                if column not in ("lumiblock", "t") and column not in self.value_columns]
+
+        models = data_set.models
+        if params['columnar']:
+            models = itertools.chain.from_iterable(models)
+
+        rows = 0
+        try:
+            for batch in batches(models, params['batch_size'] or BULK_BATCH_SIZE):
+                series = collections.OrderedDict()
+                for row in batch:
+                    key = tuple(row[i] for i in key_indexes)
+                    series.setdefault(key, []).append(row)
+                for key, key_rows in series.items():
+                    t = [row[t_index] for row in key_rows]
+                    values = np.array([[row[i] for i in value_indexes]
+                        for row in key_rows], dtype=float)
+                    rows += self.store.append(ds_class_name, run_number,
+                            lumiblock, key, t, values)
+            self.store.commit()
+        except Exception:
+            self.store.rollback()
+            raise
+        return rows
+
+
+class NameInterner(object):
+    """Ids of the names of a dimension table, inserted on first use"""
+    def __init__(self, model):
+        self.table = model._meta.db_table
+        self.ids = {}
+
+    def __call__(self, name):
+        id_ = self.ids.get(name)
+        if id_ is None:
+            conn = db.get_conn()
+            conn.execute('INSERT OR IGNORE INTO "%s" (name) VALUES (?)' % self.table,
+                    (name, ))
+            id_ = self.ids[name] = conn.execute(
+                    'SELECT id FROM "%s" WHERE name = ?' % self.table,
+                    (name, )).fetchone()[0]
+        return id_
+
+
+class NormalizedBackend(object):
+    """Rows of a PBeast dataset in the normalized tables: names become ids
+    of the entity and variable dimension tables, times integers"""
+    def __init__(self):
+        db.connect()
+        create_normalized_schema()
+        db.close()
+        self.interners = dict((model, NameInterner(model))
+                for model in (EntityModel, VariableModel))
+
+    def converter(self, column):
+        if column in NAME_COLUMNS:
+            return self.interners[NAME_COLUMNS[column][1]]
+        if column in ("t", "channel"):
+            return int
+        return None
+
+    def insert(self, data_set):
+        params = data_set.parsed_params
+        columns = data_set.datasource.columns
+        converters = [self.converter(column) for column in columns]
+        models = data_set.models
+        if params['columnar']:
+            models = itertools.chain.from_iterable(models)
+        rows = (tuple(value if convert is None else convert(value)
+            for convert, value in zip(converters, row)) for row in models)
+
+        loader = BulkLoader(NORMALIZED_MODELS[data_set.model],
+                normalized_columns(columns))
+        try:
+            return loader.load(rows, params['batch_size'] or BULK_BATCH_SIZE)
+        except Exception:
+            # Ids handed out in the failed transaction may be reused
+            for interner in self.interners.values():
+                interner.ids.clear()
+            raise
+
+
+STORAGE_BACKENDS = {
+        "sqlite": SQLiteBackend,
+        "series": SeriesStoreBackend,
+        "normalized": NormalizedBackend,
+        }
+_backends = {}
+
+
+def storage_backend(name, store_dir=None):
+    """Shared backend instance, the series store opens its catalog once"""
+    if name not in _backends:
+        if name == "series":
+            _backends[name] = SeriesStoreBackend(store_dir)
+        else:
+            _backends[name] = STORAGE_BACKENDS[name]()
+    return _backends[name]
+
+
+class DatasetExportAction(object):
+    """Write PBeast datasets of a run to columnar files, one per lumiblock"""
+    def __init__(self, namespace):
+        writer_class = columnar_export.WRITERS[namespace['format']]
+
+        query = LumiBlockModel.select().where(
+                LumiBlockModel.run_number==namespace['run_number'])
+        if namespace['first_lumiblock'] is not None:
+            query = query.where(LumiBlockModel.lumiblock >= namespace['first_lumiblock'])
+        if namespace['last_lumiblock'] is not None:
+            query = query.where(LumiBlockModel.lumiblock <= namespace['last_lumiblock'])
+        lumiblocks = list(query.order_by(LumiBlockModel.lumiblock))
+
+        for ds_class_name in select_datasets(namespace['dataset'], namespace['profile']):
             klass = getattr(sys.modules[__name__], ds_class_name)
+            for lumi in lumiblocks:
+                data_set = klass(run_number=namespace['run_number'],
+                        stime=lumi.stime, etime=lumi.etime, lumiblock=lumi.lumiblock)
+                self.export(data_set, writer_class, namespace['output'],
+                        namespace['schema'])
+
+    def export(self, data_set, writer_class, outdir, schema='legacy'):
+        """Stream the rows of a dataset lumiblock from SQLite to a partition.
+        A dataset's rows are the ones of its model with its attribute as
+        var_name. The tables hold the lumiblock number but not the run, so
+        the rows are also kept to the time window of the lumiblock. The
+        normalized schema is read through its names view."""
+        ds_class_name = data_set.__class__.__name__
+        params = data_set.parsed_params
+        columns = [column for column in data_set.datasource.columns if column != 'lumiblock']
+        fields = data_set.model._meta.fields
+        table = data_set.model._meta.db_table
+        if schema == 'normalized':
+            table = names_view(data_set.model)
+        sql = 'SELECT %s FROM "%s" WHERE "%s" = ? AND "%s" = ? AND "%s" BETWEEN ? AND ?' % (
+                ", ".join('"%s"' % fields[column].db_column for column in columns),
+                table,
+                fields['lumiblock'].db_column, fields['var_name'].db_column,
+                fields['t'].db_column)
+        cursor = db.execute_sql(sql, (int(params['lumiblock']), params['attrib'],
+            int(params['stime']), int(params['etime'])))
+
+        path = columnar_export.partition_path(outdir, ds_class_name,
+                int(params['run_number']), int(params['lumiblock']), writer_class.extension)
+        writer = None
+        rows = 0
+        while True:
+            chunk = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not chunk:
+                break
+            if writer is None:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                writer = writer_class(path, columns)
+            writer.write(chunk)
+            rows += len(chunk)
+
+        if writer is None:
+            logging.info("No rows of %s in lumiblock %s, nothing exported" %
+                    (ds_class_name, params['lumiblock']))
+            return
+        writer.close()
+        logging.info("Exported %d rows of %s to %s" % (rows, ds_class_name, path))
+
+
+class MigrateAction(object):
+    """Copy the rows of the legacy PBeast tables to the normalized schema,
+    and their ingest ledger entries to the normalized backend ones"""
+    def __init__(self, namespace):
+        db.connect()
+        create_normalized_schema()
+        IngestLedgerModel.create_table(fail_silently=True)
+        with db.transaction():
+            for model, normalized in NORMALIZED_MODELS.items():
+                self.migrate(model, normalized)
+            self.migrate_ledger(namespace['purge'])
+            if namespace['purge']:
+                for model in NORMALIZED_MODELS:
+                    db.execute_sql('DELETE FROM "%s"' % model._meta.db_table)
+        if namespace['purge']:
+            logging.info("Reclaiming the space of the legacy tables")
+            db.execute_sql("VACUUM")
+        db.close()
+
+    def migrate_ledger(self, purge=False):
+        fields = IngestLedgerModel._meta.fields
+        table = IngestLedgerModel._meta.db_table
+        names = [name for name in IngestLedgerModel._meta.get_field_names() if name != 'id']
+        columns = ['"%s"' % fields[name].db_column for name in names]
+        dataset = '"%s"' % fields['dataset'].db_column
+        where = 'WHERE %s IN (%s)' % (dataset, ", ".join("?" * len(pbeast_datasets)))
+        db.execute_sql('INSERT OR IGNORE INTO "%s" (%s) SELECT %s FROM "%s" %s' % (
+            table, ", ".join(columns),
+            ", ".join(dataset + " || '+normalized'" if column == dataset else column
+                for column in columns), table, where), pbeast_datasets)
+        if purge:
+            db.execute_sql('DELETE FROM "%s" %s' % (table, where), pbeast_datasets)
+
+    def migrate(self, model, normalized):
+        fields = model._meta.fields
+        table = model._meta.db_table
+        selected, joins = [], []
+        for name in model._meta.get_field_names():
+            column = fields[name].db_column
+            if name not in NAME_COLUMNS:
+                cast = "INTEGER" if name in ("t", "channel") else None
+                selected.append('CAST(l."%s" AS %s)' % (column, cast) if cast
+                        else 'l."%s"' % column)
+                continue
+            dimension = NAME_COLUMNS[name][1]
+            db.execute_sql('INSERT OR IGNORE INTO "%s" (name) SELECT DISTINCT "%s" FROM "%s"' %
+                    (dimension._meta.db_table, column, table))
+            alias = NAME_COLUMNS[name][0][0]
+            selected.append("%s.id" % alias)
+            joins.append('JOIN "%s" %s ON %s.name = l."%s"' % (
+                dimension._meta.db_table, alias, alias, column))
+
+        normalized_fields = normalized._meta.fields
+        target = [normalized_fields[name].db_column
+                for name in normalized_columns(model._meta.get_field_names())]
+        cursor = db.execute_sql('INSERT OR IGNORE INTO "%s" (%s) SELECT %s FROM "%s" l %s' % (
+            normalized._meta.db_table, ", ".join('"%s"' % column for column in target),
+            ", ".join(selected), table, " ".join(joins)))
+        logging.info("Migrated %d rows of %s to %s" % (cursor.rowcount,
+            table, normalized._meta.db_table))
+
+
+class StatsAction(object):
+    """Statistics of stored PBeast datasets from the per lumiblock
+    aggregates, merged over whatever is not grouped by"""
+    group_columns = {"lumiblock": "lumiblock", "entity": "entity", "var": "var_name"}
 
-        input_params = namespace
+    def __init__(self, namespace):
+        names = select_datasets(namespace['dataset'], namespace['profile'])
+        query = AggregateModel.select().where(
+                (AggregateModel.run_number == namespace['run_number']) &
+                (AggregateModel.dataset << names))
+        if namespace['first_lumiblock'] is not None:
+            query = query.where(AggregateModel.lumiblock >= namespace['first_lumiblock'])
+        if namespace['last_lumiblock'] is not None:
+            query = query.where(AggregateModel.lumiblock <= namespace['last_lumiblock'])
+        if namespace['entity']:
+            query = query.where(AggregateModel.entity << namespace['entity'])
+        query = query.order_by(AggregateModel.dataset, AggregateModel.lumiblock,
+                AggregateModel.entity, AggregateModel.var_name)
+
+        group_by = [self.group_columns[name] for name in namespace['by']]
+        groups = collections.OrderedDict()
+        for aggregate in query:
+            key = (aggregate.dataset, ) + tuple(getattr(aggregate, column)
+                    for column in group_by)
+            if key not in groups:
+                groups[key] = aggregates.Summary()
+            groups[key].merge(aggregate.summary())
+
+        percentiles = namespace['percentiles']
+        print("\t".join(["dataset"] + group_by + ["count", "mean", "stddev",
+            "min", "max"] + ["p%g" % p for p in percentiles]))
+        for key, summary in groups.items():
+            values = [summary.count, summary.mean, summary.variance ** 0.5,
+                    summary.minimum, summary.maximum]
+            values.extend(summary.quantile(p / 100.0) for p in percentiles)
+            print("\t".join([str(column) for column in key] +
+                ["%.10g" % value for value in values]))
+
+
+class FollowAction(object):
+    """Ingest a run in progress: every interval, poll PBeast for what each
+    dataset got since its high-water marks and append only the new points.
+
+    Lumiblocks of --length seconds are added after the last one of the run
+    as time advances. A window starts after the oldest mark of the series
+    of the dataset, but at most --late seconds before the last poll, so a
+    series that stopped publishing does not drag every poll back. The
+    marks move in the insert transaction, so a restarted follow carries on
+    where it stopped. Once a lumiblock is complete, its partial windows
+    in the ingest ledger are merged into one entry for the whole lumiblock,
+    which is what retrieve --multiple skips.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.klasses = [getattr(sys.modules[__name__], name)
+                for name in select_datasets(namespace['dataset'], namespace['profile'])]
+        get_pbeast_data.configure(read_timeout=namespace['timeout'],
+                url=namespace['pbeast_url'], sso=namespace['sso'],
+                retries=namespace['retries'])
+        for model in (HighWaterMarkModel, IngestLedgerModel, FailedWindowModel):
+            model.create_table(fail_silently=True)
+        self.run = self.register_run()
 
-        data_set = klass(**input_params)
+        try:
+            while True:
+                horizon = int(time.time())
+                if namespace['until']:
+                    horizon = min(horizon, namespace['until'])
+                self.poll(horizon)
+                if namespace['metrics_out']:
+                    metrics.registry.write(namespace['metrics_out'], namespace['metrics_format'])
+                if namespace['once'] or horizon == namespace['until']:
+                    break
+                time.sleep(max(0, namespace['interval'] - (time.time() - horizon)))
+        except KeyboardInterrupt:
+            logging.info("Stopped following run %d" % self.run.run_number)
+        for line in metrics.registry.summary():
+            logging.info(line)
+
+    def register_run(self):
+        run_number = self.namespace['run_number']
+        try:
+            return RunModel.get(RunModel.run_number == run_number)
+        except RunModel.DoesNotExist:
+            if self.namespace['stime'] is None:
+                raise Exception("Run %d is not registered, give its start with --stime" %
+                        run_number)
+        logging.info("Registering run %d" % run_number)
+        return RunModel.create(run_number=run_number, stime=self.namespace['stime'],
+                etime=self.namespace['stime'])
+
+    def extend_lumiblocks(self, horizon):
+        """Lumiblocks of the run up to horizon, adding the missing ones. The
+        run and its last lumiblock end at --until, so that lumiblock gets
+        closed too."""
+        lumiblocks = list(LumiBlockModel.select().where(
+            LumiBlockModel.run_number == self.run.run_number).order_by(LumiBlockModel.lumiblock))
+        length = self.namespace['length']
+        until = self.namespace['until']
+        with db.transaction():
+            while True:
+                if lumiblocks:
+                    lumiblock, stime = lumiblocks[-1].lumiblock + 1, lumiblocks[-1].etime + 1
+                else:
+                    lumiblock, stime = 0, self.run.stime
+                if stime > horizon:
+                    break
+                etime = stime + length - 1
+                if until is not None:
+                    etime = min(etime, until)
+                lumiblocks.append(LumiBlockModel.create(run_number=self.run.run_number,
+                    lumiblock=lumiblock, stime=stime, etime=etime))
+                logging.info("Lumiblock %d of run %d started" % (lumiblock, self.run.run_number))
+            if until is not None and lumiblocks and lumiblocks[-1].etime > until >= lumiblocks[-1].stime:
+                # Added by an earlier follow without this --until
+                LumiBlockModel.update(etime=until).where(
+                        (LumiBlockModel.run_number == self.run.run_number) &
+                        (LumiBlockModel.lumiblock == lumiblocks[-1].lumiblock)).execute()
+                lumiblocks[-1].etime = until
+            etime = max(horizon, self.run.etime)
+            if until is not None:
+                etime = min(etime, until)
+            if etime != self.run.etime:
+                self.run.etime = etime
+                self.run.save()
+        return lumiblocks
+
+    def poll(self, horizon):
+        lumiblocks = self.extend_lumiblocks(horizon)
+        for klass in self.klasses:
+            name = ledger_name(klass.__name__, self.namespace)
+            marks = high_water_marks(name, self.run.run_number)
+            polled = marks.pop(HORIZON, None)
+            if polled is not None and polled >= horizon:
+                continue
+            if polled is None:
+                start = self.run.stime
+            elif marks:
+                start = max(min(marks.values()) + 1, polled - self.namespace['late'])
+            else:
+                start = polled + 1
+            windows = [lumi for lumi in lumiblocks
+                    if lumi.etime >= start and lumi.stime <= horizon]
+            try:
+                rows = 0
+                for lumi in windows:
+                    rows += self.follow(klass, lumi, max(start, lumi.stime),
+                            min(horizon, lumi.etime), marks,
+                            horizon if lumi is windows[-1] else None)
+            except Exception as e:
+                logging.error("Could not follow %s, trying again at the next poll: %s" %
+                        (name, e))
+                continue
+            self.close_lumiblocks(name, lumiblocks, horizon)
+            logging.info("%d new rows of %s up to %d" % (rows, name, horizon))
+
+    def follow(self, klass, lumi, stime, etime, marks, horizon=None):
+        """Store the new points of one lumiblock window, return the rows"""
+        params = dict(self.namespace, stime=stime, etime=etime,
+                lumiblock=lumi.lumiblock, run_number=self.run.run_number)
+        data_set = klass(**params)
         data_set.get_data()
+        data_set.pbeast_data, moved = new_points(data_set.pbeast_data, marks)
+        if horizon:
+            moved[HORIZON] = horizon
+        data_set.high_water_marks = moved
         data_set.parse_input()
         data_set.transform()
-        data_set.insert()
-        logging.info("Data object %s stored" % ds_class_name)
+        rows = data_set.insert()
+        marks.update((series, t) for series, t in moved.items() if series != HORIZON)
+        return rows
+
+    def close_lumiblocks(self, dataset, lumiblocks, horizon):
+        """Merge the ledger entries of the complete lumiblocks into one each"""
+        clause = ((IngestLedgerModel.dataset == dataset) &
+                (IngestLedgerModel.run_number == self.run.run_number))
+        entries = collections.defaultdict(list)
+        for entry in IngestLedgerModel.select().where(clause):
+            entries[int(entry.lumiblock)].append(entry)
+        for lumi in lumiblocks:
+            windows = [(int(entry.stime), int(entry.etime)) for entry in entries[lumi.lumiblock]]
+            if lumi.etime > horizon or not windows or windows == [(lumi.stime, lumi.etime)]:
+                continue
+            with db.transaction():
+                IngestLedgerModel.delete().where(clause &
+                        (IngestLedgerModel.lumiblock == lumi.lumiblock)).execute()
+                IngestLedgerModel.insert(dataset=dataset, run_number=self.run.run_number,
+                        lumiblock=lumi.lumiblock, stime=lumi.stime, etime=lumi.etime,
+                        rows=sum(entry.rows for entry in entries[lumi.lumiblock]),
+                        ingested_at=int(time.time())).execute()
+
+
+class BackfillAction(object):
+    """Retrieve many runs in parallel: each run is retrieved by its own
+    masada process into its own shard DB, and every shard is merged into
+    the main DB as soon as its run is done.
+
+    A shard starts with the run, lumiblocks and ingest ledger of its run
+    from the main DB, so lumiblocks already ingested are skipped. Merging is
+    one INSERT OR IGNORE ... SELECT per table from the attached shard, in
+    one transaction; the names of the normalized tables are interned again
+    on the way. Shards of failed runs are kept, with their log, and a new
+    backfill carries on from them. The series store backend is refused,
+    its store has no shards to merge.
+    """
+    local_models = ("RunModel", "LumiBlockModel", "DeferredIndexModel")
+    # Rows expected in both DBs: the names, and the seeded ledger entries
+    shared_models = ("EntityModel", "VariableModel", "IngestLedgerModel")
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        if option_value(shlex.split(namespace['retrieve_options']), '--backend') == 'series':
+            raise Exception("backfill cannot use --backend series, the shards "
+                    "would all write to the one series store of --store-dir")
+        self.shard_dir = os.path.abspath(namespace['shard_dir'])
+        if not os.path.isdir(self.shard_dir):
+            os.makedirs(self.shard_dir)
+        for model in (IngestLedgerModel, FailedWindowModel):
+            model.create_table(fail_silently=True)
+        create_normalized_schema()
+
+        requested = run_numbers(namespace['runs'])
+        registered = set(run.run_number for run in
+                RunModel.select().where(RunModel.run_number << requested))
+        for run_number in requested:
+            if run_number not in registered:
+                logging.warning("Run %d is not registered, skipping it, try "
+                        "'retrieve %d --dataset RunDS' first" % (run_number, run_number))
+        runs = [run_number for run_number in requested if run_number in registered]
+
+        processes = namespace['processes'] or multiprocessing.cpu_count()
+        pool = ThreadPool(min(processes, len(runs)) or 1)
+        failed = []
+        try:
+            for run_number, shard, returncode in pool.imap_unordered(self.retrieve, runs):
+                if returncode:
+                    logging.error("Run %d failed, its shard and log are kept in %s" %
+                            (run_number, self.shard_dir))
+                    failed.append(run_number)
+                    continue
+                self.merge(shard)
+                logging.info("Run %d merged" % run_number)
+                if not namespace['keep_shards']:
+                    os.remove(shard)
+                    os.remove(shard + ".log")
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            raise Exception("Runs %s failed" % " ".join(str(run) for run in sorted(failed)))
+
+    def command(self, shard, *args):
+        return [sys.executable, os.path.abspath(__file__), "--db", shard] + list(args)
+
+    def retrieve(self, run_number):
+        """Retrieve a run into its shard, in a masada process"""
+        shard = os.path.join(self.shard_dir, "run-%d.db" % run_number)
+        with open(shard + ".log", "a") as log:
+            if not os.path.isfile(shard):
+                returncode = subprocess.call(self.command(shard, "initialize", "--all"),
+                        stdout=log, stderr=subprocess.STDOUT)
+                if returncode:
+                    return run_number, shard, returncode
+            self.seed(shard, run_number)
+            logging.info("Retrieving run %d into %s" % (run_number, shard))
+            returncode = subprocess.call(self.command(shard, "retrieve", str(run_number),
+                "--multiple") + shlex.split(self.namespace['retrieve_options']),
+                stdout=log, stderr=subprocess.STDOUT)
+        return run_number, shard, returncode
+
+    def seed(self, shard, run_number):
+        """Copy the run and what is known of its ingest to the shard"""
+        conn = sqlite3.connect(shard, timeout=60)
+        try:
+            conn.execute("ATTACH DATABASE ? AS source", (db.database, ))
+            with conn:
+                for model in (RunModel, LumiBlockModel, IngestLedgerModel, FailedWindowModel):
+                    table = model._meta.db_table
+                    conn.execute('INSERT OR IGNORE INTO main."%s" SELECT * FROM source."%s" '
+                            'WHERE "%s" = ?' % (table, table,
+                                model._meta.fields['run_number'].db_column), (run_number, ))
+        finally:
+            conn.close()
+
+    def merge(self, shard):
+        conn = db.get_conn()
+        conn.execute("ATTACH DATABASE ? AS shard", (shard, ))
+        try:
+            tables = set(row[0] for row in conn.execute(
+                "SELECT name FROM shard.sqlite_master WHERE type = 'table'"))
+            models = [model for model in BaseModel.__subclasses__()
+                    if model.__name__ not in self.local_models and
+                    model._meta.db_table in tables]
+            # Names first, the normalized rows are translated to their ids
+            models.sort(key=lambda model: model not in (EntityModel, VariableModel))
+            with db.transaction():
+                for model in models:
+                    model.create_table(fail_silently=True)
+                    if model is FailedWindowModel:
+                        # The shard knows which failures of its run are still current
+                        db.execute_sql('DELETE FROM main."%s" WHERE "%s" IN (SELECT "%s" FROM shard."%s")' % (
+                            model._meta.db_table, model._meta.fields['run_number'].db_column,
+                            RunModel._meta.fields['run_number'].db_column, RunModel._meta.db_table))
+                    table = model._meta.db_table
+                    rows = conn.execute('SELECT count(*) FROM shard."%s"' % table).fetchone()[0]
+                    changes = conn.total_changes
+                    db.execute_sql(self.merge_sql(model))
+                    ignored = rows - (conn.total_changes - changes)
+                    if ignored and model.__name__ not in self.shared_models:
+                        logging.warning("%d rows of %s in %s conflict with the DB and "
+                                "were not merged" % (ignored, table, os.path.basename(shard)))
+                        metrics.registry.count("rows_not_merged", ignored, table=table)
+                    elif ignored:
+                        logging.info("%d rows of %s in %s were already in the DB" %
+                                (ignored, table, os.path.basename(shard)))
+        finally:
+            conn.execute("DETACH DATABASE shard")
+
+    def merge_sql(self, model):
+        fields = model._meta.fields
+        table = model._meta.db_table
+        names = [name for name in model._meta.get_field_names()
+                if not isinstance(fields[name], PrimaryKeyField)]
+        selected, joins = [], []
+        for name in names:
+            dimension = dict(NAME_COLUMNS.values()).get(name)
+            if dimension is None or model not in NORMALIZED_MODELS.values():
+                selected.append('s."%s"' % fields[name].db_column)
+                continue
+            dimension_table = dimension._meta.db_table
+            alias = name[0]
+            selected.append('%s.id' % alias)
+            joins.append('JOIN shard."%s" s%s ON s%s.id = s."%s" JOIN main."%s" %s ON %s.name = s%s.name' % (
+                dimension_table, alias, alias, fields[name].db_column,
+                dimension_table, alias, alias, alias))
+        return 'INSERT OR IGNORE INTO main."%s" (%s) SELECT %s FROM shard."%s" s %s' % (
+                table, ", ".join('"%s"' % fields[name].db_column for name in names),
+                ", ".join(selected), table, " ".join(joins))
+
+
+def option_value(options, name):
+    """Value of a --name VALUE or --name=VALUE command line option"""
+    for i, option in enumerate(options):
+        if option.startswith(name + "="):
+            return option[len(name) + 1:]
+        if option == name and i + 1 < len(options):
+            return options[i + 1]
+    return None
+
+
+def run_numbers(specs):
+    """Run numbers of 284000 or 284000-284010 (inclusive) arguments"""
+    runs = []
+    for spec in specs:
+        first, _, last = spec.partition("-")
+        for run_number in range(int(first), int(last or first) + 1):
+            if run_number not in runs:
+                runs.append(run_number)
+    return runs
 
 
 class Dataset(object):
+    fetch_error = None
+    high_water_marks = None
+
     def parse_params(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -229,30 +1123,168 @@ class PBeastDSMethods(object):
         params['stime'] = kwargs['stime']
         params['etime'] = kwargs['etime']
         params['lumiblock'] = kwargs['lumiblock']
+        params['run_number'] = kwargs.get('run_number')
+        params['split'] = kwargs.get('split', False)
+        params['split_workers'] = kwargs.get('split_workers', 4)
+        params['stream'] = kwargs.get('stream', False)
+        params['batch_size'] = kwargs.get('batch_size')
+        params['columnar'] = kwargs.get('columnar', False)
+        params['backend'] = kwargs.get('backend', 'sqlite')
+        params['store_dir'] = kwargs.get('store_dir', STORE_DIR)
+        # Column blocks and the series store take the bulk loader tuples
+        params['bulk'] = (kwargs.get('bulk', False) or params['columnar'] or
+                params['backend'] != 'sqlite')
+        params['resolution'] = kwargs.get('resolution')
+        params['rollup'] = kwargs.get('rollup', 'mean')
+        params['max_data_points'] = None
+        if params['resolution'] and kwargs.get('server_downsample'):
+            # PBeast reduces every series to about one point per bucket
+            params['max_data_points'] = max(1, -(-(int(params['etime']) -
+                int(params['stime'])) // params['resolution']))
+            params['split'] = False
         params.update(self.datasource.get_properties())
         return params
 
     def get_data(self, *args, **kwargs):
         logging.info("Retrieving data points from PBeast")
         try:
-            self.pbeast_data = json.loads(get_pbeast_data.get(**self.parsed_params))
+            if self.parsed_params['stream']:
+                self.pbeast_data = get_pbeast_data.iter_points(**self.parsed_params)
+            else:
+                self.pbeast_data = get_pbeast_data.get_series(**self.parsed_params)
+        except Exception as e:
+            logging.error("Could not retrieve data points for lumiblock %s: %s" %
+                    (self.parsed_params['lumiblock'], e))
+            raise
+
+    @staticmethod
+    def get_data_coalesced(data_sets, merge_ids=False):
+        """get_data for datasets whose queries only differ by attribute.
+        A dataset whose own query fails gets its fetch_error set."""
+        logging.info("Retrieving data points from PBeast for %s" %
+                ", ".join(data_set.__class__.__name__ for data_set in data_sets))
+        queries = [data_set.parsed_params for data_set in data_sets]
+        try:
+            answers = get_pbeast_data.get_coalesced(queries, merge_ids)
         except Exception as e:
+            logging.error("Could not retrieve data points for lumiblock %s: %s" %
+                    (queries[0]['lumiblock'], e))
+            raise
+        for data_set, (answer, error) in zip(data_sets, answers):
+            if error is not None:
+                logging.error("Could not retrieve %s for lumiblock %s: %s" %
+                        (data_set.__class__.__name__, data_set.parsed_params['lumiblock'], error))
+                data_set.fetch_error = error
+            else:
+                data_set.pbeast_data = answer
 
 
     def parse_input(self, *args, **kwargs):
-        self.parsed_pbeast = self.datasource.parse_input(self.pbeast_data)
+        dataset = self.__class__.__name__
+        if self.parsed_params['columnar']:
+            self.parsed_pbeast = metrics.registry.counted(
+                    self.datasource.parse_series(self.pbeast_data, self.parsed_params['stream']),
+                    "datapoints_parsed", size=lambda series: len(series[1]), dataset=dataset)
+        elif self.parsed_params['stream']:
+            self.parsed_pbeast = self.datasource.parse_stream(metrics.registry.counted(
+                self.pbeast_data, "datapoints_parsed", dataset=dataset))
+        else:
+            metrics.registry.count("datapoints_parsed", sum(len(series['datapoints'])
+                for series in self.pbeast_data), dataset=dataset)
+            self.parsed_pbeast = self.datasource.parse_input(self.pbeast_data)
 
     def transform(self, *args, **kwargs):
         logging.info("Transforming data points from PBeast")
-        self.models.extend(self.datasource.transform(self.parsed_pbeast,
-            self.parsed_params['lumiblock']))
+        if self.parsed_params['columnar']:
+            rows = self.datasource.transform_columns(self.parsed_pbeast,
+                self.parsed_params['lumiblock'])
+        else:
+            rows = self.datasource.transform_stream(self.parsed_pbeast,
+                self.parsed_params['lumiblock'], self.parsed_params['bulk'])
+        if self.parsed_params['stream']:
+            # Rows are only produced while insert consumes them
+            self.models = rows
+        else:
+            self.models.extend(rows)
 
     def insert(self):
-        logging.info("Inserting RoSInput objects to DB")
+        if self.parsed_params['resolution']:
+            return self.insert_rollup()
+        logging.info("Inserting %s objects to DB" % self.model.__name__)
+        backend = storage_backend(self.parsed_params['backend'],
+                self.parsed_params['store_dir'])
         db.connect()
+        AggregateModel.create_table(fail_silently=True)
+        # The values of a window are summarized once, whatever the backends
+        # it is stored in
+        aggregator = None
+        if not self.ingested_elsewhere():
+            aggregator = RowAggregator(self.datasource.columns)
+            self.models = aggregator.tap(self.models, self.parsed_params['columnar'])
         with db.transaction(): 
-            self.model.insert_many(self.models).execute()
+            rows = backend.insert(self)
+            self.record_ingest(rows)
+            metrics.registry.count("rows_inserted", rows, dataset=self.__class__.__name__)
+            if aggregator is not None:
+                aggregator.store(self.__class__.__name__,
+                        self.parsed_params['run_number'], self.parsed_params['lumiblock'])
         db.close() 
+        return rows
+
+    def insert_rollup(self):
+        """Store the rows bucketed on the --resolution grid instead of the
+        raw rows"""
+        params = self.parsed_params
+        logging.info("Inserting %s %ds %s rollup to DB" % (self.__class__.__name__,
+            params['resolution'], params['rollup']))
+        rollup = Rollup(self.datasource.columns, params['resolution'], params['rollup'])
+        models = self.models
+        if params['columnar']:
+            models = itertools.chain.from_iterable(models)
+        db.connect()
+        RollupModel.create_table(fail_silently=True)
+        with db.transaction():
+            rows = 0
+            for batch in batches(rollup.reduce(models), BATCH_SIZE // 2):
+                for row in batch:
+                    row.update(dataset=self.__class__.__name__,
+                            run_number=int(params['run_number']))
+                RollupModel.insert_many(batch).execute()
+                rows += len(batch)
+            self.record_ingest(rows)
+            metrics.registry.count("rows_inserted", rows, dataset=self.__class__.__name__)
+        db.close()
+        return rows
+
+    def ingested_elsewhere(self):
+        """Whether the window is already stored with another backend"""
+        names = [ledger_name(self.__class__.__name__, dict(self.parsed_params, backend=name))
+                for name in STORAGE_BACKENDS if name != self.parsed_params['backend']]
+        names = [name for name in names
+                if name != ledger_name(self.__class__.__name__, self.parsed_params)]
+        if not names:
+            return False
+        return IngestLedgerModel.select().where(
+                (IngestLedgerModel.dataset << names) &
+                window_clause(IngestLedgerModel, self.parsed_params)).exists()
+
+    def record_ingest(self, rows):
+        """Mark the lumiblock window as done, in the insert transaction"""
+        IngestLedgerModel.insert(
+                dataset=ledger_name(self.__class__.__name__, self.parsed_params),
+                run_number=self.parsed_params['run_number'],
+                lumiblock=self.parsed_params['lumiblock'],
+                stime=self.parsed_params['stime'],
+                etime=self.parsed_params['etime'],
+                rows=rows,
+                ingested_at=int(time.time())).execute()
+        FailedWindowModel.delete().where(
+                (FailedWindowModel.dataset == ledger_name(self.__class__.__name__,
+                    self.parsed_params)) &
+                window_clause(FailedWindowModel, self.parsed_params)).execute()
+        if self.high_water_marks:
+            save_high_water_marks(ledger_name(self.__class__.__name__, self.parsed_params),
+                    self.parsed_params['run_number'], self.high_water_marks)
 
 
 class TrafficShappingCreditsDS(PBeastDSMethods, Dataset):
@@ -374,15 +1406,15 @@ class RoSInputRateDS(PBeastDSMethods, Dataset):
 
 
 class RunModel(BaseModel):
-    run_number = DecimalField(primary_key=True)
-    stime = DecimalField()
-    etime = DecimalField()
+    run_number = IntegerField(primary_key=True)
+    stime = IntegerField()
+    etime = IntegerField()
 
 class LumiBlockModel(BaseModel):
     run_number = ForeignKeyField(RunModel)
-    lumiblock = DecimalField(null=False)
-    stime = DecimalField()
-    etime = DecimalField()
+    lumiblock = IntegerField(null=False)
+    stime = IntegerField()
+    etime = IntegerField()
 
     class Meta:
         indexes = (
@@ -437,65 +1469,593 @@ class RoSModel(BaseModel):
         primary_key = CompositeKey('t', 'ros_name', 'channel', 'var_name')
         database = db 
 
+class IngestLedgerModel(BaseModel):
+    dataset = CharField()
+    run_number = DecimalField()
+    lumiblock = DecimalField()
+    stime = DecimalField()
+    etime = DecimalField()
+    rows = IntegerField()
+    ingested_at = IntegerField()
+
+    class Meta:
+        indexes = (
+                (('dataset', 'run_number', 'lumiblock', 'stime', 'etime'), True),
+                )
+
+
+def ingested_windows(dataset, run_number):
+    """Set of (lumiblock, stime, etime) already stored for a dataset"""
+    IngestLedgerModel.create_table(fail_silently=True)
+    query = IngestLedgerModel.select().where(
+            (IngestLedgerModel.dataset == dataset) &
+            (IngestLedgerModel.run_number == run_number))
+    return set((int(entry.lumiblock), int(entry.stime), int(entry.etime))
+            for entry in query)
+
+
+class FailedWindowModel(BaseModel):
+    """Lumiblock windows that could not be retrieved from PBeast, kept until
+    retrieve --replay-failed stores them"""
+    dataset = CharField()
+    run_number = DecimalField()
+    lumiblock = DecimalField()
+    stime = DecimalField()
+    etime = DecimalField()
+    error = TextField()
+    attempts = IntegerField()
+    failed_at = IntegerField()
+
+    class Meta:
+        indexes = (
+                (('dataset', 'run_number', 'lumiblock', 'stime', 'etime'), True),
+                )
+
+
+def window_clause(model, params):
+    """Where clause of the ledger entry of a dataset lumiblock window"""
+    return ((model.run_number == params['run_number']) &
+            (model.lumiblock == params['lumiblock']) &
+            (model.stime == params['stime']) &
+            (model.etime == params['etime']))
+
+
+def failed_windows(dataset, run_number):
+    """Set of (lumiblock, stime, etime) that failed for a dataset"""
+    query = FailedWindowModel.select().where(
+            (FailedWindowModel.dataset == dataset) &
+            (FailedWindowModel.run_number == run_number))
+    return set((int(entry.lumiblock), int(entry.stime), int(entry.etime))
+            for entry in query)
+
+
+def record_failure(data_set, error):
+    """Keep the window of a dataset that could not be retrieved or stored,
+    counting the runs it failed in"""
+    params = data_set.parsed_params
+    dataset = ledger_name(data_set.__class__.__name__, params)
+    logging.error("Could not retrieve %s lumiblock %s, recorded for replay: %s" %
+            (data_set.__class__.__name__, params['lumiblock'], error))
+    clause = (FailedWindowModel.dataset == dataset) & window_clause(FailedWindowModel, params)
+    db.connect()
+    with db.transaction():
+        previous = list(FailedWindowModel.select().where(clause))
+        attempts = previous[0].attempts if previous else 0
+        FailedWindowModel.delete().where(clause).execute()
+        FailedWindowModel.insert(dataset=dataset,
+                run_number=params['run_number'],
+                lumiblock=params['lumiblock'],
+                stime=params['stime'],
+                etime=params['etime'],
+                error=str(error),
+                attempts=attempts + 1,
+                failed_at=int(time.time())).execute()
+    db.close()
+    metrics.registry.count("windows_failed", dataset=data_set.__class__.__name__)
+
+
+class HighWaterMarkModel(BaseModel):
+    """Last timestamp stored per series of a followed dataset. The HORIZON
+    series holds the time the dataset was polled up to."""
+    dataset = CharField()
+    run_number = IntegerField()
+    series = CharField()
+    t = DecimalField()
+
+    class Meta:
+        indexes = (
+                (('dataset', 'run_number', 'series'), True),
+                )
+
+HORIZON = "*"
+
+
+def high_water_marks(dataset, run_number):
+    """{series label: last stored t} of a followed dataset"""
+    query = HighWaterMarkModel.select().where(
+            (HighWaterMarkModel.dataset == dataset) &
+            (HighWaterMarkModel.run_number == run_number))
+    return dict((entry.series, int(entry.t)) for entry in query)
+
+
+def save_high_water_marks(dataset, run_number, marks):
+    db.get_conn().executemany('INSERT OR REPLACE INTO "%s" (%s) VALUES (?, ?, ?, ?)' % (
+        HighWaterMarkModel._meta.db_table,
+        ", ".join('"%s"' % HighWaterMarkModel._meta.fields[name].db_column
+            for name in ("dataset", "run_number", "series", "t"))),
+        [(dataset, int(run_number), series, t) for series, t in marks.items()])
+
+
+def new_points(answer, marks):
+    """Drop the points of a readSeries answer at or before the high-water
+    mark of their series. Return the rest and the marks they move."""
+    kept, moved = [], {}
+    for series in answer:
+        mark = marks.get(series['label'])
+        datapoints = [d for d in series['datapoints'] if mark is None or d[0] > mark]
+        if datapoints:
+            kept.append(dict(series, datapoints=datapoints))
+            moved[series['label']] = max(d[0] for d in datapoints)
+    return kept, moved
+
+
+class AggregateModel(BaseModel):
+    """aggregates.Summary of the req values of a dataset lumiblock, per
+    entity and variable"""
+    dataset = CharField()
+    run_number = IntegerField()
+    lumiblock = IntegerField()
+    entity = CharField()
+    var_name = CharField()
+    samples = IntegerField()
+    minimum = FloatField()
+    maximum = FloatField()
+    mean = FloatField()
+    m2 = FloatField()
+    sketch = TextField()
+
+    class Meta:
+        indexes = (
+                (('dataset', 'run_number', 'lumiblock', 'entity', 'var_name'), True),
+                )
+
+    def summary(self):
+        return aggregates.Summary(self.samples, self.minimum, self.maximum,
+                self.mean, self.m2, aggregates.QuantileSketch.loads(self.sketch))
+
+
+class RowAggregator(object):
+    """Summaries of the rows of a dataset lumiblock on their way to the
+    storage backend. The entity is made of the columns that are neither
+    time, variable nor value, e.g. the ROS name and channel."""
+    value_columns = ("min_req", "req", "max_req")
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.value_index = columns.index("req")
+        self.var_index = columns.index("var_name")
+        self.entity_indexes = [i for i, column in enumerate(columns)
+                if column not in ("lumiblock", "t", "var_name") and
+                column not in self.value_columns]
+        self.summaries = {}
+
+    def observe(self, row):
+        if isinstance(row, dict):
+            row = [row[column] for column in self.columns]
+        value = row[self.value_index]
+        if value is None or value != value: # Missing or NaN
+            return
+        key = (":".join(str(row[i]) for i in self.entity_indexes), row[self.var_index])
+        summary = self.summaries.get(key)
+        if summary is None:
+            summary = self.summaries[key] = aggregates.Summary()
+        summary.add(float(value))
+
+    def tap(self, models, columnar=False):
+        """Pass the rows, or the column blocks, through while observing them"""
+        for item in models:
+            if columnar:
+                item = list(item)
+                for row in item:
+                    self.observe(row)
+            else:
+                self.observe(item)
+            yield item
+
+    def store(self, dataset, run_number, lumiblock):
+        """Write the summaries, merged with the ones of an earlier window of
+        the same lumiblock. Runs in the caller's transaction."""
+        run_number, lumiblock = int(run_number), int(lumiblock)
+        where = ((AggregateModel.dataset == dataset) &
+                (AggregateModel.run_number == run_number) &
+                (AggregateModel.lumiblock == lumiblock))
+        for aggregate in AggregateModel.select().where(where):
+            key = (aggregate.entity, aggregate.var_name)
+            if key in self.summaries:
+                self.summaries[key].merge(aggregate.summary())
+            else:
+                self.summaries[key] = aggregate.summary()
+        AggregateModel.delete().where(where).execute()
+
+        rows = [dict(dataset=dataset, run_number=run_number, lumiblock=lumiblock,
+            entity=entity, var_name=var_name, samples=summary.count,
+            minimum=summary.minimum, maximum=summary.maximum, mean=summary.mean,
+            m2=summary.m2, sketch=summary.sketch.dumps())
+            for (entity, var_name), summary in self.summaries.items()]
+        # 11 columns per row stays under SQLite's 999 variables
+        for batch in batches(rows, BATCH_SIZE // 2):
+            AggregateModel.insert_many(batch).execute()
+
+
+class RollupModel(BaseModel):
+    """PBeast rows bucketed on a time grid of resolution seconds, buckets
+    are cut at the lumiblock edges"""
+    dataset = CharField()
+    run_number = IntegerField()
+    lumiblock = IntegerField()
+    resolution = IntegerField()
+    aggregation = CharField()
+    entity = CharField()
+    var_name = CharField()
+    t = IntegerField() # Bucket start
+    samples = IntegerField()
+    min_req = FloatField(null=True)
+    req = FloatField(null=True)
+    max_req = FloatField(null=True)
+
+    class Meta:
+        indexes = (
+                (('dataset', 'run_number', 'resolution', 'aggregation',
+                    'lumiblock', 'entity', 'var_name', 't'), True),
+                )
+
+
+class Rollup(object):
+    """Streaming reduction of the rows of a dataset lumiblock to one row per
+    series and time bucket. Only the open bucket of every series is kept,
+    the points of a series come in time order."""
+    functions = {
+            "mean": lambda values: sum(values) / len(values),
+            "min": min,
+            "max": max,
+            "last": lambda values: values[-1],
+            }
+    value_columns = ("min_req", "req", "max_req")
+
+    def __init__(self, columns, resolution, aggregation="mean"):
+        self.columns = columns
+        self.resolution = resolution
+        self.aggregation = aggregation
+        self.function = self.functions[aggregation]
+        self.t_index = columns.index("t")
+        self.lumiblock_index = columns.index("lumiblock")
+        self.var_index = columns.index("var_name")
+        self.values = [(column, columns.index(column))
+                for column in self.value_columns if column in columns]
+        self.entity_indexes = [i for i, column in enumerate(columns)
+                if column not in ("lumiblock", "t", "var_name") and
+                column not in self.value_columns]
+
+    def reduce(self, rows):
+        """Yield RollupModel row dicts, without dataset and run number"""
+        open_buckets = collections.OrderedDict()
+        for row in rows:
+            if isinstance(row, dict):
+                row = [row[column] for column in self.columns]
+            key = (row[self.lumiblock_index],
+                    ":".join(str(row[i]) for i in self.entity_indexes),
+                    row[self.var_index])
+            t = int(row[self.t_index])
+            start = t - t % self.resolution
+            bucket = open_buckets.get(key)
+            if bucket is not None and bucket[0] != start:
+                yield self.row(key, *open_buckets.pop(key))
+                bucket = None
+            if bucket is None:
+                bucket = open_buckets[key] = (start, [])
+            bucket[1].append([row[i] for _, i in self.values])
+        for key, (start, points) in open_buckets.items():
+            yield self.row(key, start, points)
+
+    def row(self, key, start, points):
+        lumiblock, entity, var_name = key
+        row = dict(lumiblock=int(lumiblock), resolution=self.resolution,
+                aggregation=self.aggregation, entity=entity, var_name=var_name,
+                t=start, samples=len(points))
+        for (column, _), values in zip(self.values, zip(*points)):
+            values = [float(value) for value in values
+                    if value is not None and value == value]
+            row[column] = self.function(values) if values else None
+        return row
+
+
+def ledger_name(ds_class_name, params):
+    """Datasets stored as rollups, or with another backend than the legacy
+    SQLite tables, are tracked apart"""
+    if params.get('resolution'):
+        return "%s@%ds/%s" % (ds_class_name, params['resolution'],
+                params.get('rollup', 'mean'))
+    if params.get('backend', 'sqlite') != 'sqlite':
+        return "%s+%s" % (ds_class_name, params['backend'])
+    return ds_class_name
+
+
+class DeferredIndexModel(BaseModel):
+    name = CharField(primary_key=True)
+    sql = TextField()
+
+
+# Normalized schema: the names are interned once in the dimension tables
+# and the PBeast rows only hold integer ids, integer times and real values.
+# The name ids are plain integers, peewee would index every foreign key.
+
+class EntityModel(BaseModel):
+    name = CharField(unique=True)
+
+class VariableModel(BaseModel):
+    name = CharField(unique=True)
+
+class NormalizedHLTInputRateModel(BaseModel):
+    lumiblock = ForeignKeyField(LumiBlockModel)
+    t = IntegerField()
+    var = IntegerField(db_column='var_id')
+    req = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey('t', 'lumiblock', 'var')
+
+class NormalizedCreditsModel(BaseModel):
+    lumiblock = ForeignKeyField(LumiBlockModel)
+    t = IntegerField()
+    entity = IntegerField(db_column='entity_id')
+    var = IntegerField(db_column='var_id')
+    req = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey('t', 'lumiblock', 'entity', 'var')
+
+class NormalizedEventLatencyModel(BaseModel):
+    lumiblock = ForeignKeyField(LumiBlockModel)
+    t = IntegerField()
+    entity = IntegerField(db_column='entity_id')
+    var = IntegerField(db_column='var_id')
+    req = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey('t', 'lumiblock', 'entity', 'var')
+
+class NormalizedRoSModel(BaseModel):
+    lumiblock = ForeignKeyField(LumiBlockModel)
+    t = IntegerField()
+    ros = IntegerField(db_column='ros_id')
+    channel = IntegerField()
+    var = IntegerField(db_column='var_id')
+    min_req = FloatField()
+    req = FloatField()
+    max_req = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey('t', 'ros', 'channel', 'var')
+
+PBEAST_MODELS = [HLTInputRateModel, CreditsModel, EventLatencyModel, RoSModel]
+NORMALIZED_MODELS = collections.OrderedDict([
+        (HLTInputRateModel, NormalizedHLTInputRateModel),
+        (CreditsModel, NormalizedCreditsModel),
+        (EventLatencyModel, NormalizedEventLatencyModel),
+        (RoSModel, NormalizedRoSModel),
+        ])
+# Row column: (normalized field, dimension model)
+NAME_COLUMNS = {
+        "entity_name": ("entity", EntityModel),
+        "ros_name": ("ros", EntityModel),
+        "var_name": ("var", VariableModel),
+        }
+
+
+def normalized_columns(columns):
+    return [NAME_COLUMNS[column][0] if column in NAME_COLUMNS else column
+            for column in columns]
+
+
+def names_view(model):
+    return "%s_names" % NORMALIZED_MODELS[model]._meta.db_table
+
+
+def create_normalized_schema():
+    """Create the normalized tables, if missing, and the views that join
+    them back to the legacy column names"""
+    for model in [EntityModel, VariableModel] + list(NORMALIZED_MODELS.values()):
+        model.create_table(fail_silently=True)
+
+    for model, normalized in NORMALIZED_MODELS.items():
+        fields = model._meta.fields
+        table = normalized._meta.db_table
+        selected, joins = [], []
+        for name in model._meta.get_field_names():
+            if name not in NAME_COLUMNS:
+                selected.append('f."%s"' % normalized._meta.fields[name].db_column)
+                continue
+            field_name, dimension = NAME_COLUMNS[name]
+            alias = field_name[0]
+            selected.append('%s.name AS "%s"' % (alias, fields[name].db_column))
+            joins.append('JOIN "%s" %s ON %s.id = f."%s"' % (
+                dimension._meta.db_table, alias, alias,
+                normalized._meta.fields[field_name].db_column))
+        db.execute_sql('CREATE VIEW IF NOT EXISTS "%s" AS SELECT %s FROM "%s" f %s' % (
+            names_view(model), ", ".join(selected), table, " ".join(joins)))
+
 datasets = [kls.__name__ for kls in Dataset.__subclasses__()]
+pbeast_datasets = [kls.__name__ for kls in Dataset.__subclasses__()
+        if issubclass(kls, PBeastDSMethods)]
 datasets_info = [kls.info for kls in Dataset.__subclasses__()]
 
+class ColumnBlock(object):
+    """Rows of one series kept as columns, ordered like the data source
+    columns: a NumPy array for the values that change per point and a
+    plain value for the ones constant over the series. Iterating yields
+    the row tuples, so the block only expands when it is written."""
+    def __init__(self, *columns):
+        self.columns = columns
+
+    def __iter__(self):
+        return iter(zip(*[column.tolist() if isinstance(column, np.ndarray)
+                else itertools.repeat(column) for column in self.columns]))
+
+
+class ROSBlock(object):
+    """Decoded ROS series: rows are only expanded from the present samples
+    of the (time x channel) mask when the block is written"""
+    def __init__(self, lumiblock, t, ros_name, var_name, values, mask):
+        self.lumiblock = lumiblock
+        self.t = t
+        self.ros_name = ros_name
+        self.var_name = var_name
+        self.values = values
+        self.mask = mask
+
+    def __iter__(self):
+        times, channels = np.nonzero(self.mask)
+        samples = self.values[times, channels]
+        return iter(ColumnBlock(self.lumiblock, self.t[times], self.ros_name,
+            channels, self.var_name, samples[:, 0], samples[:, 1], samples[:, 2]))
+
+
+def datapoint_columns(datapoints):
+    """Time and value arrays of [[t, value], ...]. Nulls become NaN, which
+    SQLite stores as NULL."""
+    if np is None:
+        raise Exception("The columnar transform needs NumPy")
+    points = np.array(datapoints, dtype=float)
+    t = points[:, 0]
+    if np.array_equal(t, np.floor(t)):
+        t = t.astype(np.int64)
+    return t, points[:, 1]
+
+
+def coalesce(data_sets):
+    """Group the datasets whose PBeast queries only differ by attribute,
+    keeping the order of the first member of each group"""
+    groups = collections.OrderedDict()
+    for data_set in data_sets:
+        if isinstance(data_set, PBeastDSMethods):
+            key = get_pbeast_data.coalesce_key(data_set.parsed_params)
+        else:
+            key = id(data_set)
+        groups.setdefault(key, []).append(data_set)
+    return list(groups.values())
+
+
+DATASET_PROFILES = {
+        "simulation": ["AcceptedEventLatencyDS", "RejectedEventLatencyDS",
+            "L1EventLatencyDS", "AcceptedEventAmountDS", "RejectedEventAmountDS",
+            "ActiveTPUsPerRackAmountDS", "TrafficShappingCreditsDS",
+            "HLTInputRateDS", "RoSInputBandwidthDS", "RoSEnabledDS",
+            "RoSInputRateDS"],
+        "hlt": ["AcceptedEventLatencyDS", "RejectedEventLatencyDS",
+            "L1EventLatencyDS", "AcceptedEventAmountDS", "RejectedEventAmountDS",
+            "ActiveTPUsPerRackAmountDS"],
+        "ros": ["RoSInputBandwidthDS", "RoSEnabledDS", "RoSInputRateDS"],
+        }
+
+
+def select_datasets(names=None, profile=None):
+    """Dataset class names from --dataset and --profile, in order, once each"""
+    selected = list(names or [])
+    if profile:
+        selected.extend(DATASET_PROFILES[profile])
+    if not selected:
+        raise Exception("No dataset selected, use --dataset or --profile")
+    return [name for i, name in enumerate(selected) if name not in selected[:i]]
+
 class DataSources(object):
-    pass
+    def parse_input(self, json_obj):
+        return list(self.parse_stream(get_pbeast_data.iter_labelled(json_obj)))
+
+    def parse_stream(self, points):
+        """Yield the parsed rows of an iterator of (label, datapoint)"""
+        for label, d in points:
+            for row in self.parse_datapoint(label, d):
+                yield row
+
+    def parse_datapoint(self, label, d):
+        raise NotImplementedError()
+
+    def transform(self, objects_list, lumiblock, as_tuples=False):
+        return list(self.transform_stream(objects_list, lumiblock, as_tuples))
+
+    def transform_stream(self, objects_list, lumiblock, as_tuples=False):
+        """Yield model rows, as dicts or as tuples ordered like columns"""
+        transform = self.transform_tuple if as_tuples else self.transform_row
+        for row in objects_list:
+            yield transform(row, lumiblock)
+
+    def transform_row(self, row, lumiblock):
+        return dict(zip(self.columns, self.transform_tuple(row, lumiblock)))
+
+    def transform_tuple(self, row, lumiblock):
+        raise NotImplementedError()
+
+    def parse_series(self, answer, stream=False):
+        """Yield (label, datapoints) per series. A streamed answer is cut
+        in runs of consecutive points of the same series."""
+        if stream:
+            return get_pbeast_data.iter_series(answer, BULK_BATCH_SIZE)
+        return ((series["label"], series["datapoints"]) for series in answer)
+
+    def transform_columns(self, series, lumiblock):
+        """Yield the rows of each (label, datapoints) as one block, an
+        iterable of tuples ordered like columns. Data sources without a
+        vectorized transform fall back to the row path."""
+        for label, datapoints in series:
+            yield [self.transform_tuple(row, lumiblock)
+                    for d in datapoints
+                    for row in self.parse_datapoint(label, d)]
 
 class MultipleMeasureDataSources(DataSources): 
-    def transform(self, objects_list, lumiblock):
-        transformed_obj_list = []
-        for var_name, t, value in objects_list:
-            s_var_name = var_name.split('.')[2]
-            entity_name = var_name.split('.')[4]
+    columns = ("lumiblock", "t", "entity_name", "var_name", "req")
 
-            ds = {"lumiblock": lumiblock,
-                    "t": t,
-                    "entity_name": entity_name,
-                    "var_name": s_var_name,
-                    "req": value}
+    def transform_columns(self, series, lumiblock):
+        for label, datapoints in series:
+            if not datapoints:
+                continue
+            names = label.split('.')
+            t, value = datapoint_columns(datapoints)
+            yield ColumnBlock(lumiblock, t, names[4], names[2], value)
 
-            transformed_obj_list.append(ds)
-        return transformed_obj_list
+    def transform_tuple(self, row, lumiblock):
+        var_name, t, value = row
+        s_var_name = var_name.split('.')[2]
+        entity_name = var_name.split('.')[4]
 
+        return (lumiblock, t, entity_name, s_var_name, value)
 
-    def parse_input(self, json_obj): 
-        rows = []
-        for data in json_obj:
-            data_name = data["label"]
-            for d in data["datapoints"]:
-                t = d[0]
-                value = d[1]
-                row = [data_name, t, value]
-                rows.append(row)
-        return rows
+
+    def parse_datapoint(self, data_name, d):
+        t = d[0]
+        value = d[1]
+        return [[data_name, t, value]]
 
 class SingleMeasureDataSources(DataSources): 
-    def transform(self, objects_list, lumiblock):
-        transformed_obj_list = []
-        for var_name, t, value in objects_list:
-            var_name = var_name.split('.')[2]
+    columns = ("lumiblock", "t", "var_name", "req")
 
-            ds = {"lumiblock": lumiblock,
-                    "t": t,
-                    "var_name": var_name,
-                    "req": value}
+    def transform_columns(self, series, lumiblock):
+        for label, datapoints in series:
+            if not datapoints:
+                continue
+            t, value = datapoint_columns(datapoints)
+            yield ColumnBlock(lumiblock, t, label.split('.')[2], value)
 
-            transformed_obj_list.append(ds)
-        return transformed_obj_list
+    def transform_tuple(self, row, lumiblock):
+        var_name, t, value = row
+        var_name = var_name.split('.')[2]
 
+        return (lumiblock, t, var_name, value)
 
-    def parse_input(self, json_obj): 
-        rows = []
-        for data in json_obj:
-            data_name = data["label"]
-            for d in data["datapoints"]:
-                t = d[0]
-                value = d[1]
-                row = [data_name, t, value]
-                rows.append(row)
-        return rows
+
+    def parse_datapoint(self, data_name, d):
+        t = d[0]
+        value = d[1]
+        return [[data_name, t, value]]
     
 
 class HLTInputRateDataSource(SingleMeasureDataSources):
@@ -587,44 +2147,113 @@ class AcceptedEventsDatasource(MultipleMeasureDataSources):
 
 
 class ROSDataSource(DataSources):
+    columns = ("lumiblock", "t", "ros_name", "channel", "var_name",
+               "min_req", "req", "max_req")
+
     def __init__(self): 
         self.header = ["ros.name", "t", "channel", "min.req", "req",
                               "max.req"] 
-
-    def transform(self, objects_list, lumiblock):
-        transformed_obj_list = []
-        for ros_name, t, channel, min_req, req, max_req in objects_list:
-            ros_vars_name = ros_name.split('.')
-            n_ros_name = ".".join(ros_vars_name[-2:])
-            var_name = ros_vars_name[2]
-
-            ds = {"lumiblock": lumiblock, "t": t,
-                    "ros_name": n_ros_name,
-                    "channel": int(channel),
-                    "var_name": var_name, "min_req": float(min_req),
-                    "req": float(req), "max_req": float(max_req)}
-            transformed_obj_list.append(ds)
-        return transformed_obj_list
-
-
-    def parse_input(self, json_obj): 
+        self.malformed = 0
+
+    def report_malformed(self, malformed, lumiblock=None):
+        if not malformed:
+            return
+        metrics.registry.count("malformed_samples", malformed,
+                source=self.__class__.__name__)
+        logging.warning("Skipped %d malformed ROS channel samples%s" % (malformed,
+            "" if lumiblock is None else " in lumiblock %s" % lumiblock))
+
+    def transform_tuple(self, row, lumiblock):
+        ros_name, t, channel, min_req, req, max_req = row
+        ros_vars_name = ros_name.split('.')
+        n_ros_name = ".".join(ros_vars_name[-2:])
+        var_name = ros_vars_name[2]
+
+        return (lumiblock, t, n_ros_name, int(channel), var_name,
+                float(min_req), float(req), float(max_req))
+
+    def transform_columns(self, series, lumiblock):
+        malformed = 0
+        for label, datapoints in series:
+            if not datapoints:
+                continue
+            ros_vars_name = label.split('.')
+            t, values, mask, bad = self.decode(datapoints)
+            malformed += bad
+            yield ROSBlock(lumiblock, t, ".".join(ros_vars_name[-2:]),
+                    ros_vars_name[2], values, mask)
+        self.report_malformed(malformed, lumiblock)
+
+    def decode(self, datapoints):
+        """Dense arrays of ROS datapoints, [t, [[min, avg, max] or [value]
+        or null per channel]]: times (n), values (n x channels x 3, single
+        values repeated) and the (n x channels) mask of present samples,
+        plus the count of malformed samples left out of the mask"""
+        if np is None:
+            raise Exception("The columnar transform needs NumPy")
+        n = len(datapoints)
+        channels = max([len(d[1]) for d in datapoints
+            if len(d) > 1 and isinstance(d[1], list)] or [0])
+
+        t = np.empty(n)
+        values = np.empty((n, channels, 3))
+        values.fill(np.nan)
+        mask = np.zeros((n, channels), dtype=bool)
+        malformed = 0
+        for i, d in enumerate(datapoints):
+            t[i] = d[0]
+            chans = d[1] if len(d) > 1 else None
+            if not chans:
+                continue
+            if not isinstance(chans, list):
+                malformed += 1
+                continue
+            for j, c in enumerate(chans):
+                if not c:
+                    continue
+                try:
+                    if len(c) not in (1, 3):
+                        raise ValueError("%d values" % len(c))
+                    values[i, j] = c
+                    mask[i, j] = True
+                except (TypeError, ValueError):
+                    malformed += 1
+
+        if np.array_equal(t, np.floor(t)):
+            t = t.astype(np.int64)
+        return t, values, mask, malformed
+
+
+    def parse_stream(self, points):
+        self.malformed = 0
+        for row in super(ROSDataSource, self).parse_stream(points):
+            yield row
+        self.report_malformed(self.malformed)
+
+    def parse_datapoint(self, ros_name, d):
+        """Rows of the channel samples of a datapoint, the malformed ones
+        counted and left out like the columnar decode does"""
         rows = []
-        for ros in json_obj:
-            ros_name = ros["label"]
-            for d in ros["datapoints"]:
-                ep = d[0]
-                chans = d[1:]
-                if chans[0]:
-                    try:
-                        for i, c in enumerate(chans[0]):
-                            if c:
-                                if len(c) == 1:
-                                    c = c * 3
-                                r = [ros_name, ep, i]
-                                r.extend(c)
-                                rows.append(r)
-                    except Exception as e:
-                        print(e)
+        ep = d[0]
+        chans = d[1] if len(d) > 1 else None
+        if not chans:
+            return rows
+        if not isinstance(chans, list):
+            self.malformed += 1
+            return rows
+        for i, c in enumerate(chans):
+            if not c:
+                continue
+            try:
+                if len(c) not in (1, 3):
+                    raise ValueError("%d values" % len(c))
+                values = [float(v) for v in c]
+            except (TypeError, ValueError):
+                self.malformed += 1
+                continue
+            if len(values) == 1:
+                values = values * 3
+            rows.append([ros_name, ep, i] + values)
         return rows
 
 
@@ -662,6 +2291,7 @@ class ROSInputRateDataSource(ROSDataSource):
     
 def main():
     """Main entry for the load mapping script"""
+    import dateutil.parser
     run_lumi_block = None
     try:
         # create_tables()
@@ -725,6 +2355,7 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='PBeast to Simulation parameters and metrics ETL module')
 
+    parser.add_argument('--db', default=DB_FILE, help="SQLite DB file (default: %(default)s)")
     subparsers = parser.add_subparsers(dest='subparser', title='Available commands', \
             description="Commands to interact with the retrieval, statistics and initalization routines")
 
@@ -743,19 +2374,114 @@ if __name__ == '__main__':
     retrieve_parser.add_argument('--length', type=int, help="For AllLumiblocks DS select the size (seconds) of each lumiblock") 
     retrieve_parser.add_argument('--single', dest='single', action='store_true', help="Retrieve single dataset. If chosen then select lumiblock / stime / etime")
     retrieve_parser.add_argument('--multiple', dest='single', action='store_false', help="Retrieve multiple datasets with time data from the lumiblocks datasets")
+    retrieve_parser.add_argument('--workers', type=int, default=1, help="Amount of lumiblocks fetched concurrently from PBeast with --multiple. Inserts are still done in order by a single writer")
+    retrieve_parser.add_argument('--pool-size', dest='pool_size', type=int, default=10, help="Amount of keep-alive connections kept open to PBeast")
+    retrieve_parser.add_argument('--timeout', type=int, default=300, help="Seconds to wait for a PBeast response")
+    retrieve_parser.add_argument('--retries', type=int, default=get_pbeast_data.fetch_control.RETRIES, help="Times a PBeast request that timed out, lost its connection or got a 429/5xx answer is sent again, after a jittered exponential backoff")
+    retrieve_parser.add_argument('--initial-concurrency', dest='initial_concurrency', type=int, default=get_pbeast_data.fetch_control.INITIAL_CONCURRENCY, help="PBeast requests in flight at the start. The limit grows up to the pool size while PBeast answers fast and is halved on failures")
+    retrieve_parser.add_argument('--replay-failed', dest='replay_failed', action='store_true', help="With --multiple, only retrieve the lumiblocks recorded as failed by earlier runs")
+    retrieve_parser.add_argument('--no-cache', dest='use_cache', action='store_false', help="Neither read nor store PBeast responses in the local cache")
+    retrieve_parser.add_argument('--refresh', action='store_true', help="Download again the PBeast responses already in the local cache")
+    retrieve_parser.add_argument('--cache-dir', dest='cache_dir', default=pbeast_cache.CACHE_DIR, help="Directory of the PBeast response cache")
+    retrieve_parser.add_argument('--cache-size', dest='cache_size', type=int, default=pbeast_cache.MAX_BYTES / 1024 ** 2, help="Size limit (MB) of the PBeast response cache")
+    retrieve_parser.add_argument('--split', action='store_true', help="Split long time windows so no series gets downsampled by PBeast")
+    retrieve_parser.add_argument('--split-workers', dest='split_workers', type=int, default=4, help="Amount of sub-windows of a split window fetched concurrently")
+    retrieve_parser.add_argument('--stream', action='store_true', help="Parse, transform and insert the PBeast answers incrementally while they are downloaded")
+    retrieve_parser.add_argument('--batch-size', dest='batch_size', type=int, help="Rows written per INSERT statement (%d) or per executemany call with --bulk (%d)" % (BATCH_SIZE, BULK_BATCH_SIZE))
+    retrieve_parser.add_argument('--bulk', action='store_true', help="Write the PBeast rows as tuples with sqlite3 executemany, bypassing the peewee models")
+    retrieve_parser.add_argument('--fast-ingest', dest='fast_ingest', action='store_true', help="Ingest with WAL, relaxed fsync and indexes built after the load. Durable settings are restored at the end")
+    retrieve_parser.add_argument('--no-coalesce', dest='coalesce', action='store_false', help="With --multiple, do not send together the queries of datasets that only differ by attribute")
+    retrieve_parser.add_argument('--coalesce-ids', dest='coalesce_ids', action='store_true', help="Send coalesced queries as one readSeries call with an (attr1|attr2) attribute regexp. Needs a PBeast server that accepts it")
+    retrieve_parser.add_argument('--columnar', action='store_true', help="Transform whole series as NumPy columns and write them with the bulk loader")
+    retrieve_parser.add_argument('--backend', choices=sorted(STORAGE_BACKENDS), default='sqlite', help="Storage of the PBeast rows: SQLite model tables, normalized SQLite tables with interned names or the memory-mapped series store")
+    retrieve_parser.add_argument('--store-dir', dest='store_dir', default=STORE_DIR, help="Directory of the series store backend")
+    retrieve_parser.add_argument('--resolution', type=int, help="Store the PBeast series bucketed to one row per RESOLUTION seconds, in the rollup table, instead of the raw rows")
+    retrieve_parser.add_argument('--rollup', choices=['last', 'max', 'mean', 'min'], default='mean', help="Aggregation of the points of a --resolution bucket")
+    retrieve_parser.add_argument('--server-downsample', dest='server_downsample', action='store_true', help="With --resolution, also ask PBeast for about one point per bucket (maxDataPoints) so less is downloaded. Buckets then reduce PBeast's own downsampled points")
+    retrieve_parser.add_argument('--pbeast-url', dest='pbeast_url', default=get_pbeast_data.PBEAST_URL, help="readSeries URL, e.g. the one of a pbeast_standin.py server")
+    retrieve_parser.add_argument('--no-sso', dest='sso', action='store_false', help="Do not get a CERN SSO cookie, for PBeast servers that do not need one")
+    retrieve_parser.add_argument('--metrics-out', dest='metrics_out', help="Write the run metrics (stage and PBeast call times, bytes, datapoints, rows) to this file")
+    retrieve_parser.add_argument('--metrics-format', dest='metrics_format', choices=['json', 'prometheus'], default='json', help="Format of --metrics-out, prometheus is a node_exporter textfile")
     retrieve_parser.set_defaults(single=True)
 
     
-    retrieve_parser.add_argument('--dataset', type=str, dest='dataset', default=None, \
+    retrieve_parser.add_argument('--profile', choices=sorted(DATASET_PROFILES), help="Retrieve a named group of datasets: %s" % \
+            " ### ".join("%s - %s" % (name, " ".join(names)) for name, names in sorted(DATASET_PROFILES.items())))
+    retrieve_parser.add_argument('--dataset', type=str, dest='dataset', default=None, nargs='+', choices=datasets, metavar='DATASET', \
             help="""Retrieve the datasets for a run number, a lumiblock and a time interval.
 If neither exists they are created at runtime.
 \tAvailable datasets are:
 %s""" % (" ### ".join(help_text)))
 
+    export_parser = subparsers.add_parser('export',
+            help="Export stored PBeast datasets to columnar files partitioned by run and lumiblock")
+    export_parser.add_argument('run_number', type=int, help='select the run number to export')
+    export_parser.add_argument('--dataset', dest='dataset', nargs='+', choices=pbeast_datasets, metavar='DATASET', help="Datasets to export: %s" % " ".join(pbeast_datasets))
+    export_parser.add_argument('--profile', choices=sorted(DATASET_PROFILES), help="Export a named group of datasets")
+    export_parser.add_argument('--first-lumiblock', dest='first_lumiblock', type=int, help="First lumiblock to export")
+    export_parser.add_argument('--last-lumiblock', dest='last_lumiblock', type=int, help="Last lumiblock to export")
+    export_parser.add_argument('--format', choices=sorted(columnar_export.WRITERS), default='npz', help="npz needs NumPy, parquet needs pyarrow")
+    export_parser.add_argument('--schema', choices=['legacy', 'normalized'], default='legacy', help="Read the legacy model tables or the normalized ones")
+    export_parser.add_argument('--output', default='export', help="Directory of the exported partitions, <output>/<dataset>/run=<run>/lumiblock=<lumiblock>")
+
+    migrate_parser = subparsers.add_parser('migrate',
+            help="Copy the PBeast rows of an existing DB to the normalized schema")
+    migrate_parser.add_argument('--purge', action='store_true', help="Empty the legacy tables once copied and VACUUM the DB file")
+
+    follow_parser = subparsers.add_parser('follow',
+            help="Ingest a run in progress, polling PBeast for the new points of every dataset")
+    follow_parser.add_argument('run_number', type=int, help='select the run number to follow')
+    follow_parser.add_argument('--dataset', dest='dataset', nargs='+', choices=pbeast_datasets, metavar='DATASET', help="Datasets to follow: %s" % " ".join(pbeast_datasets))
+    follow_parser.add_argument('--profile', choices=sorted(DATASET_PROFILES), help="Follow a named group of datasets")
+    follow_parser.add_argument('--stime', type=int, help="Start of the run, when it is not registered yet")
+    follow_parser.add_argument('--until', type=int, help="Stop once the datasets are ingested up to this time, e.g. the end of the run")
+    follow_parser.add_argument('--length', type=int, default=60, help="Seconds per lumiblock added as the run advances")
+    follow_parser.add_argument('--interval', type=int, default=60, help="Seconds between polls")
+    follow_parser.add_argument('--late', type=int, default=300, help="Seconds a series may lag behind the last poll and still be polled again from its own high-water mark")
+    follow_parser.add_argument('--once', action='store_true', help="Poll once and exit, e.g. from cron")
+    follow_parser.add_argument('--bulk', action='store_true', help="As retrieve --bulk")
+    follow_parser.add_argument('--backend', choices=['normalized', 'sqlite'], default='sqlite', help="As retrieve --backend")
+    follow_parser.add_argument('--timeout', type=int, default=300, help="Seconds to wait for a PBeast response")
+    follow_parser.add_argument('--retries', type=int, default=get_pbeast_data.fetch_control.RETRIES, help="As retrieve --retries")
+    follow_parser.add_argument('--pbeast-url', dest='pbeast_url', default=get_pbeast_data.PBEAST_URL, help="readSeries URL, e.g. the one of a pbeast_standin.py server")
+    follow_parser.add_argument('--no-sso', dest='sso', action='store_false', help="Do not get a CERN SSO cookie, for PBeast servers that do not need one")
+    follow_parser.add_argument('--metrics-out', dest='metrics_out', help="Write the run metrics to this file after every poll")
+    follow_parser.add_argument('--metrics-format', dest='metrics_format', choices=['json', 'prometheus'], default='json', help="Format of --metrics-out")
+
+    backfill_parser = subparsers.add_parser('backfill',
+            help="Retrieve many runs in parallel, each into its own shard DB, and merge them into the DB")
+    backfill_parser.add_argument('runs', nargs='+', metavar='RUN', help="Run numbers or inclusive ranges like 284000-284010, registered with RunDS and AllLumiblocksDS")
+    backfill_parser.add_argument('--processes', type=int, help="Runs retrieved at once, one process each (default: the number of CPUs)")
+    backfill_parser.add_argument('--retrieve-options', dest='retrieve_options', default='', help="Options given to every 'retrieve RUN --multiple', e.g. \"--profile simulation --bulk\"")
+    backfill_parser.add_argument('--shard-dir', dest='shard_dir', default='shards', help="Directory of the per run shard DBs and their logs")
+    backfill_parser.add_argument('--keep-shards', dest='keep_shards', action='store_true', help="Keep the shards once merged")
+
+    stats_parser = subparsers.add_parser('stats',
+            help="Statistics of stored PBeast datasets, from the aggregates kept at insert time")
+    stats_parser.add_argument('run_number', type=int, help='select the run number')
+    stats_parser.add_argument('--dataset', dest='dataset', nargs='+', choices=pbeast_datasets, metavar='DATASET', help="Datasets to summarize: %s" % " ".join(pbeast_datasets))
+    stats_parser.add_argument('--profile', choices=sorted(DATASET_PROFILES), help="Summarize a named group of datasets")
+    stats_parser.add_argument('--first-lumiblock', dest='first_lumiblock', type=int, help="First lumiblock to include")
+    stats_parser.add_argument('--last-lumiblock', dest='last_lumiblock', type=int, help="Last lumiblock to include")
+    stats_parser.add_argument('--entity', nargs='+', help="Only these entities, e.g. tpu-rack-00 or <ROS name>:<channel>")
+    stats_parser.add_argument('--by', nargs='*', choices=sorted(StatsAction.group_columns), default=['entity', 'var'], help="Group by these besides the dataset, merging the rest (default: entity var)")
+    stats_parser.add_argument('--percentiles', nargs='*', type=float, default=[50, 90, 99], help="Percentiles to report, within 1%% of an actual value")
+
     # The parse_args executes the DatasetRetrieve action
     args = parser.parse_args()
+    db.init(os.path.abspath(args.db))
     if args.subparser == 'initialize':
         args.initialize()
     if args.subparser == 'retrieve':
         DatasetRetrieveAction(vars(args))
+    if args.subparser == 'export':
+        DatasetExportAction(vars(args))
+    if args.subparser == 'stats':
+        StatsAction(vars(args))
+    if args.subparser == 'migrate':
+        MigrateAction(vars(args))
+    if args.subparser == 'follow':
+        FollowAction(vars(args))
+    if args.subparser == 'backfill':
+        BackfillAction(vars(args))
     # main()
@@ -0,0 +1,140 @@
+"""Run metrics: time spent per pipeline stage and PBeast call, plus counts
+of bytes downloaded, datapoints parsed and rows inserted.
+
+Timers and counters are keyed by a name and labels, e.g. the stage and
+the dataset, and are safe to update from the fetch threads. Timed stages
+of concurrent workers overlap, so their sum can exceed the run time.
+The registry is summarized in the log at the end of a retrieve and can be
+written as JSON or as a Prometheus textfile.
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+import contextlib
+import collections
+
+PREFIX = "masada_"
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict() # (name, labels): value
+        self.timers = collections.OrderedDict() # (name, labels): [calls, seconds]
+        self.start = time.time()
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def counted(self, iterable, name, size=None, **labels):
+        """Pass the items of iterable through, counting them, or their
+        size(item), once the iteration is over"""
+        total = 0
+        try:
+            for item in iterable:
+                total += 1 if size is None else size(item)
+                yield item
+        finally:
+            self.count(name, total, **labels)
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def totals(self, entries, by=None):
+        """Sum entries over their labels, except the by label"""
+        summed = collections.OrderedDict()
+        for (name, labels), value in entries.items():
+            key = (name, dict(labels).get(by)) if by else (name, None)
+            if isinstance(value, list):
+                previous = summed.get(key, [0, 0.0])
+                summed[key] = [previous[0] + value[0], previous[1] + value[1]]
+            else:
+                summed[key] = summed.get(key, 0) + value
+        return summed
+
+    def summary(self):
+        """Log lines with the totals of every timer and counter"""
+        with self.lock:
+            timers = self.totals(self.timers, by="stage")
+            counters = self.totals(self.counters)
+        lines = ["Run took %.3fs" % self.elapsed()]
+        for (name, stage), (calls, seconds) in timers.items():
+            lines.append("%s: %.3fs over %d calls" % (
+                "%s %s" % (name, stage) if stage else name, seconds, calls))
+        for (name, _), value in counters.items():
+            lines.append("%s: %d" % (name, value))
+        return lines
+
+    def as_json(self):
+        with self.lock:
+            return {
+                "run_seconds": self.elapsed(),
+                "timers": [dict(name=name, labels=dict(labels), calls=calls, seconds=seconds)
+                           for (name, labels), (calls, seconds) in self.timers.items()],
+                "counters": [dict(name=name, labels=dict(labels), value=value)
+                             for (name, labels), value in self.counters.items()],
+            }
+
+    def as_prometheus(self):
+        def labelled(name, labels):
+            if not labels:
+                return PREFIX + name
+            return "%s%s{%s}" % (PREFIX, name, ",".join(
+                '%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels))
+
+        with self.lock:
+            timers = list(self.timers.items())
+            counters = list(self.counters.items())
+        # The samples of a metric family have to be contiguous
+        families = collections.OrderedDict()
+        for (name, labels), (calls, seconds) in timers:
+            families.setdefault(name + "_seconds_total", []).append((labels, "%f" % seconds))
+            families.setdefault(name + "_calls_total", []).append((labels, "%d" % calls))
+        for (name, labels), value in counters:
+            families.setdefault(name + "_total", []).append((labels, "%d" % value))
+
+        lines = ["# TYPE %srun_seconds gauge" % PREFIX,
+                 "%srun_seconds %f" % (PREFIX, self.elapsed())]
+        for family, samples in families.items():
+            lines.append("# TYPE %s%s counter" % (PREFIX, family))
+            for labels, value in samples:
+                lines.append("%s %s" % (labelled(family, labels), value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, format="json"):
+        """Write the report aside and rename it, so a textfile collector
+        never reads a partial file"""
+        if format == "prometheus":
+            text = self.as_prometheus()
+        else:
+            text = json.dumps(self.as_json(), indent=2)
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(prefix=".tmp", dir=dirname)
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.rename(tmppath, path)
+
+
+registry = Metrics()
@@ -0,0 +1,120 @@
+"""Content-addressed on-disk cache for PBeast readSeries responses.
+
+Responses are stored gzip compressed under the sha1 of the request URL and
+parameters. The total size is bounded and the least recently used entries
+are evicted first; a hit refreshes the entry mtime, which is what the
+eviction orders on.
+"""
+import os
+import gzip
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+CACHE_DIR = os.path.expanduser("~/.cache/masada/pbeast")
+MAX_BYTES = 2 * 1024 ** 3 # 2 GB
+EVICT_TO = 0.9 # Fraction of max_bytes left after an eviction
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseCache(object):
+    def __init__(self, cachedir=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.size = sum(size for _, _, size in self._entries())
+
+    def key(self, url, parameters):
+        blob = json.dumps([url, parameters], sort_keys=True)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], key + ".json.gz")
+
+    def load(self, key):
+        chunks = self.reader(key)
+        if chunks is None:
+            return None
+        return b"".join(chunks).decode('utf-8')
+
+    def store(self, key, text):
+        for _ in self.writer(key, [text.encode('utf-8')]):
+            pass
+
+    def reader(self, key):
+        """Return an iterator over the stored body chunks, None on a miss"""
+        path = self.path(key)
+        try:
+            f = gzip.open(path, 'rb')
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        logging.debug("PBeast cache hit %s" % key)
+        return self._read_chunks(f)
+
+    def writer(self, key, chunks):
+        """Pass chunks through while storing them. The entry is only
+        committed once chunks is exhausted."""
+        path = self.path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass # Created by a concurrent writer
+
+        # Write aside and rename so readers never see a partial entry
+        fd, tmppath = tempfile.mkstemp(prefix='.tmp', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        yield chunk
+            os.rename(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+        with self.lock:
+            self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries())
+        self.size = sum(size for _, _, size in entries)
+        for mtime, path, size in entries:
+            if self.size <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+        logging.info("PBeast cache evicted down to %d bytes" % self.size)
+
+    def _read_chunks(self, f, chunk_size=CHUNK_SIZE):
+        with f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.cachedir):
+            for filename in filenames:
+                if not filename.endswith(".json.gz"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, path, st.st_size
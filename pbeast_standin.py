@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Offline stand-in for the PBeast readSeries service.
+
+Answers /tdaq/pbeast/readSeries with deterministic synthetic series in the
+PBeast answer format: the same query always gets the same answer. Object
+names are made up from the object regexp of the query, so labels look like
+ATLAS.HLTMPPUInfo.AverageAcceptTime.DF_IS.DefMIG-IS:HLT-3:tpu-rack-3.PU_ChildInfo,
+and ReadoutModule objects get per channel [min, avg, max] arrays like the
+ROS ones. maxDataPoints and (attr1|attr2) attributes are honoured.
+
+To exercise the retries of retrieve, --error-rate answers that fraction of
+the queries with a 503 and --max-concurrent answers 429 to the queries
+beyond that many in flight.
+
+Run it with ./pbeast_standin.py --port 8080 and point retrieve at it with
+--pbeast-url http://localhost:8080/tdaq/pbeast/readSeries --no-sso.
+"""
+import re
+import json
+import math
+import time
+import random
+import zlib
+import logging
+import argparse
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+READ_SERIES_PATH = "/tdaq/pbeast/readSeries"
+OBJECTS = 50 # Series per query, for object regexps that match many
+CHANNELS = 12 # Channels per ReadoutModule series
+PERIOD = 5 # Seconds between points
+MAX_DATA_POINTS = 5000
+
+
+def object_names(regexp, count):
+    """Names matched by an object regexp: the .* and the digit classes are
+    filled with the object number. Plain names match themselves only."""
+    if not re.search(r"[.][*+]|\[", regexp):
+        return [regexp]
+    names = []
+    for i in range(count):
+        name = re.sub(r"^\.\*|\.\*$", "", regexp)
+        name = name.replace(".*", "-SIM%03d" % (i // 2))
+        name = name.replace("[0-9]+", str(i))
+        name = re.sub(r"\[0-([0-9])\]", lambda m: str(i % (int(m.group(1)) + 1)), name)
+        names.append(name)
+    return names
+
+
+def noise(seed, t):
+    """Deterministic value in [0, 1) for a series and a time"""
+    return ((seed * 2654435761 + t * 40503) & 0xffff) / 65536.0
+
+
+def value(seed, t):
+    base = 1000.0 + seed % 1000
+    return base * (1 + 0.1 * math.sin(2 * math.pi * t / 3600.0 + seed)) + 10 * noise(seed, t)
+
+
+def ros_value(seed, t, channels):
+    chans = []
+    for j in range(channels):
+        avg = value(seed + j, t)
+        chans.append([avg * 0.9, avg, avg * 1.1])
+    return chans
+
+
+class SeriesGenerator(object):
+    def __init__(self, objects=OBJECTS, channels=CHANNELS, period=PERIOD):
+        self.objects = objects
+        self.channels = channels
+        self.period = period
+
+    def answer(self, id_str, stime, etime, max_data_points=MAX_DATA_POINTS):
+        partition, typ3, attrib, server, regexp = id_str.split(".", 4)
+        attribs = [attrib]
+        if attrib.startswith("(") and attrib.endswith(")"):
+            attribs = attrib[1:-1].split("|")
+
+        first = stime + (-stime % self.period)
+        times = list(range(first, etime + 1, self.period))
+        if len(times) > max_data_points:
+            # One of every stride points, like a downsampled PBeast answer
+            stride = int(math.ceil(len(times) / float(max_data_points)))
+            times = times[::stride]
+
+        answer = []
+        for attrib in attribs:
+            for name in object_names(regexp, self.objects):
+                label = ".".join([partition, typ3, attrib, server, name])
+                seed = zlib.crc32(label.encode("utf-8")) & 0xffffffff
+                if "ReadoutModule" in name:
+                    datapoints = [[t, ros_value(seed, t, self.channels)] for t in times]
+                else:
+                    datapoints = [[t, value(seed, t)] for t in times]
+                answer.append({"label": label, "datapoints": datapoints})
+        return answer
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real service
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != READ_SERIES_PATH:
+            self.send_error(404)
+            return
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        try:
+            answer = self.server.generator.answer(query["id"], int(query["from"]),
+                    int(query["to"]), int(query.get("maxDataPoints", MAX_DATA_POINTS)))
+        except (KeyError, ValueError) as e:
+            self.send_error(400, "Bad readSeries query: %s" % e)
+            return
+        if not self.server.admit():
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            if random.random() < self.server.error_rate:
+                self.send_error(503, "Injected failure")
+                return
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.send_answer(answer)
+        finally:
+            self.server.release()
+
+    def send_answer(self, answer):
+        body = json.dumps(answer).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("PBeast stand-in: " + format % args)
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, generator, latency=0.0, error_rate=0.0,
+                 max_concurrent=None):
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.generator = generator
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def admit(self):
+        with self.lock:
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d%s" % (host, port, READ_SERIES_PATH)
+
+    def start(self):
+        """Serve from a daemon thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def add_arguments(parser):
+    parser.add_argument('--objects', type=int, default=OBJECTS, help="Series per query for object regexps that match many objects")
+    parser.add_argument('--channels', type=int, default=CHANNELS, help="Channels per ROS ReadoutModule series")
+    parser.add_argument('--period', type=int, default=PERIOD, help="Seconds between the points of a series")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added before every answer")
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help="Fraction of the queries answered with a 503")
+    parser.add_argument('--max-concurrent', dest='max_concurrent', type=int, help="Queries answered at once, the ones beyond get a 429")
+
+
+def server_from_args(args, host="127.0.0.1", port=0):
+    generator = SeriesGenerator(args.objects, args.channels, args.period)
+    return StandinServer((host, port), generator, args.latency,
+            args.error_rate, args.max_concurrent)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline PBeast readSeries stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = server_from_args(args, args.host, args.port)
+    logging.info("Serving synthetic PBeast series on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,64 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import masada
+
+
+class RecordingWriter(object):
+    """Partition writer that keeps the rows in memory"""
+    extension = ".rows"
+    written = {}
+
+    def __init__(self, path, columns):
+        self.rows = self.written.setdefault(path, [])
+
+    def write(self, chunk):
+        self.rows.extend(chunk)
+
+    def close(self):
+        pass
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        masada.db.init(os.path.join(self.tmpdir, "test.db"))
+        masada.InitializeAction()
+        RecordingWriter.written.clear()
+
+    def tearDown(self):
+        masada.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def add_run(self, run_number, stime, attrib):
+        masada.RunModel.create(run_number=run_number, stime=stime, etime=stime + 59)
+        masada.LumiBlockModel.create(run_number=run_number, lumiblock=0,
+                stime=stime, etime=stime + 59)
+        masada.EventLatencyModel.insert_many([dict(lumiblock=0, t=t,
+            entity_name="tpu-rack-0", var_name=attrib, req=float(t))
+            for t in range(stime, stime + 60, 5)]).execute()
+
+    def test_runs_sharing_a_lumiblock_number(self):
+        attrib = masada.AcceptedEventLatencyDS(run_number=1, lumiblock=0,
+                stime=0, etime=0).parsed_params['attrib']
+        self.add_run(284001, 1448136000, attrib)
+        self.add_run(284002, 1448146000, attrib)
+
+        lumi = masada.LumiBlockModel.get(masada.LumiBlockModel.run_number == 284001)
+        data_set = masada.AcceptedEventLatencyDS(run_number=284001, lumiblock=0,
+                stime=lumi.stime, etime=lumi.etime)
+        action = masada.DatasetExportAction.__new__(masada.DatasetExportAction)
+        action.export(data_set, RecordingWriter, self.tmpdir)
+
+        rows, = RecordingWriter.written.values()
+        self.assertEqual(len(rows), 12)
+        self.assertTrue(all(1448136000 <= row[0] <= 1448136059 for row in rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pbeast_standin
+
+RUN_NUMBER = 284001
+STIME = 1448136000
+DATASET = "AcceptedEventLatencyDS"
+
+
+class FollowTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, "test.db")
+        self.server = pbeast_standin.StandinServer(("127.0.0.1", 0),
+                pbeast_standin.SeriesGenerator(objects=2))
+        self.server.start()
+        self.masada("initialize", "--all")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def masada(self, *args):
+        command = [sys.executable, os.path.join(ROOT, "masada.py"), "--db", self.db]
+        process = subprocess.Popen(command + list(args), cwd=self.tmpdir,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+
+    def query(self, sql):
+        connection = sqlite3.connect(self.db)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_retrieve_after_follow_until(self):
+        # 150 seconds are not a whole number of 60 second lumiblocks
+        self.masada("follow", str(RUN_NUMBER), "--stime", str(STIME),
+                "--until", str(STIME + 150), "--dataset", DATASET,
+                "--pbeast-url", self.server.url, "--no-sso")
+        self.assertEqual(self.query("select max(etime) from lumiblockmodel"),
+                [(STIME + 150,)])
+        self.assertEqual(self.query("select etime from runmodel"), [(STIME + 150,)])
+        ledger = self.query("select lumiblock, stime, etime from ingestledgermodel "
+                "order by lumiblock")
+        self.assertEqual(ledger, self.query("select lumiblock, stime, etime "
+                "from lumiblockmodel order by lumiblock"))
+        rows = self.query("select count(*) from eventlatencymodel")
+
+        self.masada("retrieve", str(RUN_NUMBER), "--multiple", "--dataset", DATASET,
+                "--no-cache", "--pbeast-url", self.server.url, "--no-sso")
+        self.assertEqual(self.query("select count(*) from eventlatencymodel"), rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""Append-only, memory-mapped time-series store.
+
+Every series (a dataset, a run and the row columns that are neither time
+nor value, e.g. entity and variable name) gets two flat files: int64
+timestamps and float64 values, width values per point. A small SQLite
+catalog keeps the series, their committed point count and the lumiblock
+segments appended to them. Appends and range scans are sequential I/O and
+the names are stored once per series instead of once per row.
+
+The catalog count is authoritative: bytes past it, left by an append that
+was never committed, are truncated before the next append and never read.
+"""
+import os
+import json
+import sqlite3
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CATALOG_FILENAME = "catalog.db"
+
+
+class SeriesStore(object):
+    def __init__(self, root):
+        if np is None:
+            raise Exception("The series store needs NumPy")
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.conn = sqlite3.connect(os.path.join(root, CATALOG_FILENAME))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS series (
+                id integer primary key,
+                dataset text,
+                run_number integer,
+                key text,
+                width integer,
+                count integer,
+                unique (dataset, run_number, key)
+            );
+            CREATE TABLE IF NOT EXISTS segments (
+                series_id integer,
+                lumiblock integer,
+                offset integer,
+                count integer,
+                tmin integer,
+                tmax integer,
+                primary key (series_id, offset)
+            );
+            CREATE INDEX IF NOT EXISTS segments_lumiblock
+                ON segments (lumiblock);
+        """)
+        self.conn.commit()
+
+    def path(self, series_id, run_number, dataset):
+        return os.path.join(self.root, "run=%d" % run_number, dataset,
+                            "%d" % series_id)
+
+    def has_lumiblock(self, dataset, run_number, lumiblock):
+        return self.conn.execute("""SELECT 1 FROM segments JOIN series
+                ON series.id = segments.series_id WHERE series.dataset = ?
+                AND series.run_number = ? AND segments.lumiblock = ? LIMIT 1""",
+                (dataset, run_number, lumiblock)).fetchone() is not None
+
+    def append(self, dataset, run_number, lumiblock, key, t, values):
+        """Append points to the series of key, a tuple of the row columns
+        that are neither time nor value. Visible after commit()."""
+        t = np.ascontiguousarray(t, dtype=np.int64)
+        values = np.ascontiguousarray(values, dtype=np.float64).reshape(len(t), -1)
+        key = json.dumps(list(key))
+
+        row = self.conn.execute("""SELECT id, width, count FROM series
+                WHERE dataset = ? AND run_number = ? AND key = ?""",
+                (dataset, run_number, key)).fetchone()
+        if row is None:
+            cursor = self.conn.execute("""INSERT INTO series
+                    (dataset, run_number, key, width, count) VALUES (?, ?, ?, ?, 0)""",
+                    (dataset, run_number, key, values.shape[1]))
+            row = (cursor.lastrowid, values.shape[1], 0)
+        series_id, width, count = row
+        if width != values.shape[1]:
+            raise ValueError("Series %s holds %d values per point, not %d" %
+                             (key, width, values.shape[1]))
+
+        path = self.path(series_id, run_number, dataset)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        for suffix, array, itemsize in ((".t", t, 8), (".v", values, 8 * width)):
+            with open(path + suffix, "ab") as f:
+                f.truncate(count * itemsize)
+                f.write(array.tobytes())
+
+        self.conn.execute("UPDATE series SET count = ? WHERE id = ?",
+                (count + len(t), series_id))
+        self.conn.execute("""INSERT INTO segments
+                (series_id, lumiblock, offset, count, tmin, tmax)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (series_id, lumiblock, count, len(t), int(t.min()), int(t.max())))
+        return len(t)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def scan(self, dataset, run_number, stime=None, etime=None):
+        """Yield (key, lumiblock, t, values) per segment overlapping
+        [stime, etime], as read-only memory maps trimmed to the window"""
+        query = """SELECT series.id, series.key, series.width, series.count,
+                segments.lumiblock, segments.offset, segments.count
+                FROM segments JOIN series ON series.id = segments.series_id
+                WHERE series.dataset = ? AND series.run_number = ?"""
+        params = [dataset, run_number]
+        if stime is not None:
+            query += " AND segments.tmax >= ?"
+            params.append(stime)
+        if etime is not None:
+            query += " AND segments.tmin <= ?"
+            params.append(etime)
+        query += " ORDER BY series.id, segments.offset"
+
+        for (series_id, key, width, total, lumiblock, offset,
+             count) in self.conn.execute(query, params).fetchall():
+            path = self.path(series_id, run_number, dataset)
+            t = np.memmap(path + ".t", dtype=np.int64, mode="r",
+                          shape=(total, ))[offset:offset + count]
+            values = np.memmap(path + ".v", dtype=np.float64, mode="r",
+                               shape=(total, width))[offset:offset + count]
+            start, end = 0, count
+            if stime is not None:
+                start = np.searchsorted(t, stime, side="left")
+            if etime is not None:
+                end = np.searchsorted(t, etime, side="right")
+            yield tuple(json.loads(key)), lumiblock, t[start:end], values[start:end]